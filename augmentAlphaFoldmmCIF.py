@@ -2,16 +2,40 @@ import CifFile as cif
 from resources.mmCIF_support import categoryName_loopNumber
 import argparse
 import os
-import copy
+import re
 import datetime
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import configparser
 import psycopg2
 import getpass
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
 from resources.get_id import bmrb2pdb_ID
 import shlex
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
+import hashlib
+from array import array
+import threading
+import time
+from contextlib import contextmanager
+import cProfile
+import pstats
+import tracemalloc
+import gzip
+import shutil
+import tempfile
+import queue
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 
 class ConfigObject:
@@ -192,11 +216,20 @@ class ConfigObject:
 
 
 class postgreSQL:
-    def __init__(self, cinfo, database, pw=None):
+    # named cursors of stream() must be unique within a session
+    cursorCount = 0
+
+    def __init__(self, cinfo, database, pw=None, host=None):
 
         self.application_name = 'nusforall'
+        # host that accepted the connection (host or host_local), pass it back in to skip the fallback
+        self.host = host
 
         self.conn = self.connect(cinfo, database, pw)
+        self.lastUsed = time.monotonic()
+        # names of the statements prepared on this session, and of those the server refused to prepare
+        self.prepared = set()
+        self.unpreparable = set()
 
     def connect(self, cinfo, database, pw=None):
         """
@@ -222,6 +255,18 @@ class postgreSQL:
                 "missing data, check config section {} for {}".format(DB_KEY, ke))
             raise
 
+        if self.host is not None:
+            try:
+                return psycopg2.connect(
+                    host=self.host,
+                    dbname=database,
+                    user=u,
+                    password=pw,
+                    application_name=self.application_name)
+            except psycopg2.OperationalError:
+                # the remembered host is gone, redo the host / host_local fallback
+                self.host = None
+
         try:
             conn = psycopg2.connect(
                 host=h,
@@ -241,123 +286,652 @@ class postgreSQL:
             except psycopg2.OperationalError:
                 # pwc.reject_password(u, Database.__DATABASE)
                 raise
+        self.host = h
         return conn
 
-    def query(self, q):
+    def query(self, q, params=None):
         """
         Run query against connected SQL database
         :param q: SQL query
+        :param params: optional sequence of values for the %s markers of q
         :return: returned data from DB
         """
 
         # execute query and return data
         cur = self.conn.cursor()
-        cur.execute(q)
+        try:
+            cur.execute(q, params)
+        except psycopg2.Error:
+            # leave the session usable for the next borrower
+            self.conn.rollback()
+            raise
         self.conn.commit()
+        self.lastUsed = time.monotonic()
         try:
             return cur.fetchall()
         except:
             return None
 
+    def prepare(self, statement):
+        """
+        Prepare a statement on this session, once
+        :param statement: preparedStatement of a query template
+        :return: True if the statement is prepared, False if the server cannot prepare it (e.g. the type of
+                 a parameter cannot be inferred), in which case the query has to be sent as text
+        """
+        if statement.name in self.prepared:
+            return True
+        if statement.name in self.unpreparable:
+            return False
+        try:
+            self.query('PREPARE {} AS {}'.format(statement.name, statement.text))
+        except psycopg2.ProgrammingError:
+            self.unpreparable.add(statement.name)
+            return False
+        self.prepared.add(statement.name)
+        return True
+
+    def execute_prepared(self, statement, params):
+        """
+        Run a statement prepared with prepare, reusing its plan
+        :param statement: preparedStatement
+        :param params: values of the statement parameters, in $n order
+        :return: returned data from DB
+        """
+        if not params:
+            return self.query('EXECUTE {}'.format(statement.name))
+        return self.query('EXECUTE {} ({})'.format(statement.name, ', '.join(['%s'] * len(params))), params)
+
+    def stream(self, q, itersize=2000):
+        """
+        Run a query on a named server-side cursor and yield its rows, fetching itersize rows per round trip
+        instead of holding the whole result in memory
+        :param q: SQL query
+        :param itersize: rows per fetch
+        :return: generator of row tuples
+        """
+        postgreSQL.cursorCount += 1
+        cur = self.conn.cursor(name='stream_{:d}'.format(postgreSQL.cursorCount))
+        cur.itersize = itersize
+        try:
+            cur.execute(q)
+            for row in cur:
+                yield row
+            cur.close()
+        except BaseException:
+            # also reached when the caller stops iterating early, the rollback closes the cursor
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.lastUsed = time.monotonic()
+
+    def ping(self):
+        """
+        Check that the server still answers on this connection
+        :return: True if the connection is usable
+        """
+        if self.conn.closed:
+            return False
+        try:
+            cur = self.conn.cursor()
+            cur.execute('select 1')
+            cur.fetchall()
+            self.conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+        self.lastUsed = time.monotonic()
+        return True
+
+    def close(self):
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class connectionPool:
+    """
+    Pool of persistent postgreSQL sessions for one database section of the cfg file
+    """
+
+    def __init__(self, dbSection, pw=None, size=4, timeout=60, check_interval=300):
+        """
+        :param dbSection: section from cfg file with entries: host, host_local, username, dbname
+        :param pw: password for the username in dbSection
+        :param size: maximum number of open connections
+        :param timeout: seconds to wait for a free connection before giving up (None waits forever)
+        :param check_interval: idle seconds after which a pooled connection is pinged before it is handed out
+        """
+        self.dbSection = dbSection
+        self.pw = pw
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        # host / host_local decision made by the first connection, reused by every later one
+        self.host = None
+
+        self.idle = []
+        self.open = 0
+        self.waiting = deque()
+        self.cond = threading.Condition()
+        self.stats = OrderedDict([('connects', 0), ('borrows', 0), ('waits', 0), ('reconnects', 0), ('discards', 0)])
+
+    def connect(self):
+        conn = postgreSQL(
+            cinfo=self.dbSection,
+            database=self.dbSection.dbname,
+            pw=self.pw,
+            host=self.host)
+        self.host = conn.host
+        self.stats['connects'] += 1
+        return conn
+
+    def acquire(self):
+        """
+        Borrow a connection, opening a new one while the pool is below its size
+        :return: postgreSQL object
+        """
+        with self.cond:
+            self.stats['borrows'] += 1
+            if self.waiting or (not self.idle and self.open >= self.size):
+                # queue up behind earlier borrowers so connections are handed out first come, first served
+                self.stats['waits'] += 1
+                ticket = object()
+                self.waiting.append(ticket)
+                ready = self.cond.wait_for(
+                    lambda: self.waiting[0] is ticket and (self.idle or self.open < self.size),
+                    timeout=self.timeout)
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+                if not ready:
+                    raise TimeoutError('no database connection available after {} s'.format(self.timeout))
+            if self.idle:
+                conn = self.idle.pop()
+            else:
+                conn = None
+                self.open += 1
+
+        try:
+            if conn is None:
+                return self.connect()
+            if time.monotonic() - conn.lastUsed > self.check_interval and not conn.ping():
+                conn.close()
+                self.stats['reconnects'] += 1
+                return self.connect()
+            return conn
+        except Exception:
+            with self.cond:
+                self.open -= 1
+                self.cond.notify_all()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Return a borrowed connection, closing it instead if it is broken
+        :param conn: postgreSQL object from acquire
+        :param discard: close the connection rather than keeping it for reuse
+        """
+        if discard or conn.conn.closed:
+            conn.close()
+            with self.cond:
+                self.stats['discards'] += 1
+                self.open -= 1
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.idle.append(conn)
+            self.cond.notify_all()
+
+    @contextmanager
+    def session(self):
+        """
+        Borrow a connection for the duration of a with block
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def closeall(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def metrics(self):
+        """
+        Return the pool counters along with the current number of open and idle connections
+        :return: OrderedDict
+        """
+        with self.cond:
+            m = OrderedDict(self.stats)
+            m['open'] = self.open
+            m['idle'] = len(self.idle)
+        return m
+
+
+# one connection pool per database section, shared by every queryData in the process
+connectionPools = dict()
+connectionPools_lock = threading.Lock()
+
+
+def section_option(section, param, default):
+    """
+    Return an optional parameter from a cfg section, or default when it is not set
+    """
+    try:
+        return section.get(param)
+    except KeyError:
+        return default
+
+
+def get_pool(dbSection_name, dbSection):
+    """
+    Return the connection pool for a database section, creating it on first use
+    :param dbSection_name: name of the database section in the cfg file
+    :param dbSection: section from cfg file with entries: host, host_local, username, dbname
+    :return: connectionPool
+    """
+    with connectionPools_lock:
+        pool = connectionPools.get(dbSection_name)
+        if pool is None:
+            # search the .pgpass file for local user to retrieve password for database connection
+            # TODO: Create env var for PGPASS
+            # pw = pgpasslib.getpass(
+            #     host=dbSection.get('host'),
+            #     dbname=dbSection.get('dbname'),
+            #     user=dbSection.get('username'))
+            pw = PASSWORD
+            if pw is None:
+                print('unable to retrieve password from .pgpass file')
+                pw = input('Please enter password: ')
+
+            pool = connectionPool(
+                dbSection=dbSection,
+                pw=pw,
+                size=section_option(dbSection, 'pool_size', 4),
+                timeout=section_option(dbSection, 'pool_timeout', 60),
+                check_interval=section_option(dbSection, 'pool_check_interval', 300))
+            connectionPools[dbSection_name] = pool
+        return pool
+
+
+def report_pool_metrics():
+    for name, pool in connectionPools.items():
+        print('connection pool {}: {}'.format(
+            name, ', '.join('{}={}'.format(k, v) for k, v in pool.metrics().items())))
+
+
+preparedStatement = namedtuple('preparedStatement', ['name', 'text', 'params'])
+
+
+class queryTemplate(namedtuple('queryTemplate', ['name', 'database', 'segments', 'header', 'format',
+                                                 'statement', 'itersize'])):
+    """
+    Immutable, precompiled Q_ section of the cfg file. The query text is stored split around its
+    %%%TOKEN%%% placeholders (literal text at even positions, placeholder tokens at odd positions)
+    """
+    __slots__ = ()
+
+    placeholder_pattern = re.compile(r'(%%%[A-Z_]+%%%)')
+    # placeholders substituted with SQL fragments (VALUES tuples), never parameters
+    list_placeholders = frozenset(['%%%TUPLES%%%'])
+    # comma separated id lists, bound as one integer array parameter where they are written as in (...)
+    array_placeholders = frozenset(['%%%AFIDS%%%', '%%%CSPIDS%%%'])
+    in_list_open = re.compile(r'\s+in\s*\(\s*$', re.IGNORECASE)
+    in_list_close = re.compile(r'^\s*\)')
+
+    @classmethod
+    def compile(cls, name, qSection):
+        """
+        Locate the placeholders of a Q_ section once
+        :param name: basename of the query (section name without 'Q_')
+        :param qSection: ConfigObject section with entries: database, query, header, format and optionally
+                         itersize (stream the rows on a server-side cursor, itersize rows per fetch)
+        :return: queryTemplate
+        """
+        segments = tuple(cls.placeholder_pattern.split(qSection.get('query')))
+        return cls(
+            name=name,
+            database=qSection.get('database'),
+            segments=segments,
+            header=cls.as_tuple(section_option(qSection, 'header', 'none')),
+            format=cls.as_tuple(section_option(qSection, 'format', 'none')),
+            statement=cls.parameterize(name, segments),
+            itersize=section_option(qSection, 'itersize', None))
+
+    @classmethod
+    def parameterize(cls, name, segments):
+        """
+        Translate the query into a statement with $n parameters, so the server can plan it once per session.
+        A placeholder written as a quoted literal ('%%%AFID%%%') becomes a bare parameter, an id list written
+        as in (%%%AFIDS%%%) becomes = any($n::int[]), each distinct placeholder is one parameter
+        :param name: basename of the query
+        :param segments: query text split around its placeholders
+        :return: preparedStatement, or None when the query has no placeholders, takes VALUES tuples or uses an
+                 id list outside of in (...)
+        """
+        tokens = tuple(dict.fromkeys(segments[1::2]))
+        text = cls.parameter_text(segments, tokens, marker='${:d}')
+        if text is None:
+            return None
+        return preparedStatement(name='q_{}'.format(name.lower()), text=text, params=tokens)
+
+    @classmethod
+    def parameter_text(cls, segments, tokens, marker, escape=False):
+        """
+        Replace the placeholders of the query by parameter markers, see parameterize
+        :param tokens: distinct placeholders, in parameter order
+        :param marker: format of the marker of parameter n (1-based)
+        :param escape: double the % of the query text, for markers bound by psycopg2
+        :return: query string, or None when the placeholders cannot all be parameters
+        """
+        if not tokens or cls.list_placeholders.intersection(tokens):
+            return None
+        parts = [part.replace('%', '%%') for part in segments] if escape else list(segments)
+        quotes = 0
+        for i in range(1, len(parts), 2):
+            quotes += segments[i - 1].count("'")
+            if quotes % 2:
+                # inside a string literal, only a placeholder that is the whole literal can be a parameter
+                if not (parts[i - 1].endswith("'") and parts[i + 1].startswith("'")):
+                    return None
+                parts[i - 1] = parts[i - 1][:-1]
+                parts[i + 1] = parts[i + 1][1:]
+            if segments[i] in cls.array_placeholders:
+                # e.g. array[%%%AFIDS%%%] or a list inside a literal can only be substituted as text
+                if quotes % 2 or not cls.in_list_open.search(parts[i - 1]) or \
+                        not cls.in_list_close.match(parts[i + 1]):
+                    return None
+                parts[i - 1] = cls.in_list_open.sub(' = any(', parts[i - 1])
+                parts[i] = marker.format(tokens.index(segments[i]) + 1) + '::int[]'
+                continue
+            parts[i] = marker.format(tokens.index(segments[i]) + 1)
+        return ''.join(parts)
+
+    @classmethod
+    def param_value(cls, token, value):
+        """
+        Value of a statement parameter: a comma separated id list (or a list of ids) becomes an array literal,
+        None stays None (NULL)
+        """
+        if value is None:
+            return None
+        if token in cls.array_placeholders:
+            if isinstance(value, str):
+                value = value.split(',')
+            return '{' + ','.join(str(int(val)) for val in value) + '}'
+        return str(value)
+
+    def parameters(self, subs):
+        """
+        Values of the statement parameters for a set of substitutions
+        :return: list, or None when the query has no statement or subs does not fill every parameter
+        """
+        if self.statement is None or subs is None or not all(token in subs for token in self.statement.params):
+            return None
+        return [self.param_value(token, subs[token]) for token in self.statement.params]
+
+    def bind(self, subs):
+        """
+        Build the query for a psycopg2 cursor of an open transaction, with its substitutions bound as
+        parameters rather than rendered into the text (None is bound as NULL)
+        :param subs: dictionary of substitutions filling every placeholder
+        :return: (query string with %(pN)s markers, dictionary of parameter values)
+        """
+        tokens = self.placeholders
+        if not tokens:
+            return self.render(), None
+        text = self.parameter_text(self.segments, tokens, marker='%(p{:d})s', escape=True)
+        if text is None:
+            raise ValueError('{:s} cannot be run with bound parameters'.format('Q_' + self.name))
+        params = dict()
+        for n, token in enumerate(tokens, start=1):
+            value = subs[token]
+            if token in self.array_placeholders and isinstance(value, str):
+                value = [int(val) for val in value.split(',')]
+            params['p{:d}'.format(n)] = value
+        return text, params
+
+    @staticmethod
+    def as_tuple(val):
+        if isinstance(val, list):
+            return tuple(val)
+        return (val,)
+
+    @property
+    def placeholders(self):
+        return tuple(dict.fromkeys(self.segments[1::2]))
+
+    def render(self, subs=None):
+        """
+        Build the query string for a set of substitutions
+        :param subs: dictionary of substitutions (keys=placeholder token, value=value to insert)
+        :return: query string
+        """
+        if not subs:
+            return ''.join(self.segments)
+        parts = list(self.segments)
+        for i in range(1, len(parts), 2):
+            if parts[i] in subs:
+                parts[i] = str(subs[parts[i]])
+        return ''.join(parts)
+
+
+queryRowClasses = dict()
+
+
+def query_row_class(header):
+    """
+    Return the record type of the rows of a query: a namedtuple of the header columns that can also be
+    read like the row dictionaries it replaces (row['atom'], row.keys())
+    :param header: tuple of column names
+    :return: namedtuple subclass
+    """
+    rowClass = queryRowClasses.get(header)
+    if rowClass is None:
+        index = {key: i for i, key in enumerate(header)}
+
+        class queryRow(namedtuple('queryRow', header, rename=True)):
+            __slots__ = ()
+
+            def __getitem__(self, key):
+                if isinstance(key, str):
+                    try:
+                        key = index[key]
+                    except KeyError:
+                        raise KeyError(key) from None
+                return tuple.__getitem__(self, key)
+
+            def get(self, key, default=None):
+                try:
+                    return self[key]
+                except KeyError:
+                    return default
+
+            def keys(self):
+                return header
+
+        rowClass = queryRowClasses.setdefault(header, queryRow)
+    return rowClass
+
+
+class queryRegistry:
+    """
+    A parsed cfg file together with its compiled query templates
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.templates = OrderedDict()
+        for sec in cfg.keys():
+            if sec.startswith('Q_'):
+                self.templates[sec[2:]] = queryTemplate.compile(name=sec[2:], qSection=cfg.get(sec))
+
+    def template(self, basename):
+        """
+        Return the compiled template of a query
+        :param basename: basename of the query defined in the cfg file (cfg file has sections named 'Q_'+basename
+        :return: queryTemplate
+        """
+        try:
+            return self.templates[basename]
+        except KeyError:
+            raise KeyError('query not found: {:s}'.format('Q_' + basename))
+
+
+# cfg files are parsed once per process and shared by every timedomain
+queryRegistries = dict()
+queryRegistries_lock = threading.Lock()
+
+
+def load_query_registry(cfgFile):
+    """
+    Return the query registry for a cfg file, parsing the file on first use
+    :param cfgFile: cfg filename, relative to usage/configs or absolute
+    :return: queryRegistry
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    path = os.path.abspath(os.path.join(base, 'usage', 'configs', cfgFile))
+    with queryRegistries_lock:
+        registry = queryRegistries.get(path)
+        if registry is None:
+            registry = queryRegistry(cfg=ConfigObject(file=path, list_delimiter='&'))
+            queryRegistries[path] = registry
+        return registry
+
 
 class queryData:
     """
     Class for running sql queries against db and returning result
     """
 
-    def __init__(self, cfg, basename, subs=None):
+    def __init__(self, registry, basename, subs=None, itersize=None):
 
         """
         Run a query against a database and perform substitution into the query
+        :param registry: queryRegistry holding the parsed cfg file and its compiled query templates
         :param basename: basename of the query defined in the config file (config file has sections named 'Q_'+basename
         :param subs: dictionary of substitutions to make into query string (keys=string to replace, value=string to insert)
+        :param itersize: stream the rows on a server-side cursor, itersize rows per fetch, while the queryData is
+                         iterated (default: itersize of the Q_ section; 0 fetches every row at once)
         :return: result of query and a format string for display
         """
-        self.cfg = cfg
-        try:
-            # create a copy of the template so that variable substitution can be made without
-            # overwriting the template
-            qSection_name = 'Q_' + basename
-            qSection = copy.copy(self.cfg.get(qSection_name))
-        except KeyError:
-            raise KeyError('query not found: {:s}'.format(qSection_name))
+        self.cfg = registry.cfg
+        # templates are immutable, so substitution values are only ever rendered into a new string
+        qTemplate = registry.template(basename)
 
         try:
-            dbSection_name = qSection.get('database')
+            dbSection_name = qTemplate.database
             dbSection = self.cfg.get(dbSection_name)
         except KeyError:
             raise KeyError('database not found: {:s}'.format(dbSection_name))
 
-        # modify the query by substituting substitution values
+        # build the substitution values for the query placeholders
         if subs is not None:
+            subs = dict(subs)
             for pattern in subs:
                 if basename == 'protInsert':
-                    argument_string = ",".join(
+                    subs[pattern] = ",".join(
                         "('%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s', '%s')" % (
                             a, b, c, d, e, f, g, h, i, j, k, l) for (a, b, c, d, e, f, g, h, i, j, k, l) in
                         subs[pattern])
-                    qSection.query = qSection.query.replace(pattern, argument_string)
                 elif basename == 'insertCSList':
-                    argument_string = ",".join(
+                    subs[pattern] = ",".join(
                         "('%s', '%s', '%s', '%s', '%s', '%s', '%s')" % (
                             a, b, c, d, e, f, g) for (a, b, c, d, e, f, g) in subs[pattern])
-                    qSection.query = qSection.query.replace(pattern, argument_string)
-                else:
-                    qSection.query = qSection.query.replace(pattern, str(subs[pattern]))
-
-        # get connection
-        conn = self.get_conn(dbSection=dbSection)
+        # queries with 1 column have their header and format encapsulated in a list by the template
+        self.qName = 'Q_' + qTemplate.name
+        self.qHeader = list(qTemplate.header)
+        self.qFormat = list(qTemplate.format)
+        self.data = []
 
-        # run query and capture results as a list of tuples (one for each row in the table)
-        qTuple = conn.query(qSection.query)
+        # queries with single value and id list placeholders run as prepared statements, planned once per session
+        statement = qTemplate.statement
+        params = qTemplate.parameters(subs)
 
-        self.qHeader = qSection.header
-        self.qFormat = qSection.format
+        if itersize is None:
+            itersize = qTemplate.itersize
+        if itersize:
+            # nothing runs until the rows are iterated, see stream_rows
+            self.data = None
+            self.streamArgs = (dbSection_name, dbSection, qTemplate.render(subs), itersize, statement, params)
+            return
 
-        if not isinstance(self.qFormat, list):
-            # queries with 1 column will have a format that is a string => encapsulate in list
-            self.qFormat = [self.qFormat]
-        if not isinstance(self.qHeader, list):
-            # queries with 1 column will have a header that is a string => encapsulate in list
-            self.qHeader = [self.qHeader]
+        # borrow a pooled connection and run query, capturing results as a list of tuples (one for each row in the table)
+        with self.get_conn(dbSection_name=dbSection_name, dbSection=dbSection) as conn:
+            if params is not None and conn.prepare(statement):
+                qTuple = conn.execute_prepared(statement, params)
+            else:
+                qTuple = conn.query(qTemplate.render(subs))
 
-        # iterate through list of tuples and put each into a dictionary, using header names as keys
-        self.data = []
+        # rows are records named by the header, strings are kept as they are (print() makes them ASCII)
         if qTuple is not None:
-            for tup in qTuple:
-                row_dict = {}
-                for key, val in zip(self.qHeader, tup):
-                    if isinstance(val, str):
-                        # replace all non-ASCII characters with a "?"
-                        # just for printed output - no changes made to database
-                        val = val.encode('ascii', 'replace').decode('ascii')
-                    row_dict[key] = val
-                self.data.append(row_dict)
-
-    def get_conn(self, dbSection):
-        """
-        Create a connection to a database server
+            self.data = list(self.make_rows(qTuple))
+
+    def make_rows(self, qTuple):
+        """
+        Wrap row tuples in header-named records
+        :param qTuple: iterable of row tuples
+        :return: generator of records
+        """
+        header = tuple(self.qHeader)
+        make = query_row_class(header)._make
+        width = len(header)
+        for tup in qTuple:
+            if len(tup) != width:
+                raise ValueError('{:s} returned {:d} columns for its {:d} header names: {:s}'.format(
+                    self.qName, len(tup), width, ', '.join(header)))
+            yield make(tup)
+
+    def stream_rows(self):
+        """
+        Yield the rows of a streaming queryData, holding a pooled connection until the last row. A query the
+        session can prepare runs as its prepared statement instead, fetching the rows of the batch at once: a
+        server-side cursor can only be declared over query text, which is planned again on every call
+        :return: generator of records
+        """
+        dbSection_name, dbSection, query, itersize, statement, params = self.streamArgs
+        with self.get_conn(dbSection_name=dbSection_name, dbSection=dbSection) as conn:
+            if params is not None and conn.prepare(statement):
+                yield from self.make_rows(conn.execute_prepared(statement, params) or [])
+                return
+            rows = conn.stream(query, itersize=itersize)
+            try:
+                yield from self.make_rows(rows)
+            finally:
+                # end the cursor's transaction before the connection goes back to the pool
+                rows.close()
+
+    def __iter__(self):
+        if self.data is None:
+            return self.stream_rows()
+        return iter(self.data)
+
+    def fetch(self):
+        """
+        Read the rest of a streaming result into data, for the methods that need the whole table
+        """
+        if self.data is None:
+            self.data = list(self.stream_rows())
+        return self.data
+
+    def get_conn(self, dbSection_name, dbSection):
+        """
+        Borrow a connection to a database server from the pool for this database section
+        :param dbSection_name: name of the database section in the cfg file
         :param dbSection: section from cfg file with entries: host, host_local, username, dbname
-        :return: postgreSQL object
+        :return: context manager yielding a postgreSQL object
         """
-        # search the .pgpass file for local user to retrieve password for database connection
-        # TODO: Create env var for PGPASS
-        # pw = pgpasslib.getpass(
-        #     host=dbSection.get('host'),
-        #     dbname=dbSection.get('dbname'),
-        #     user=dbSection.get('username'))
-        pw = PASSWORD
-        if pw is None:
-            print('unable to retrieve password from .pgpass file')
-            pw = input('Please enter password: ')
-
-        # create connection
-        conn = postgreSQL(
-            cinfo=dbSection,
-            database=dbSection.dbname,
-            pw=pw,
-        )
-        return conn
+        return get_pool(dbSection_name=dbSection_name, dbSection=dbSection).session()
 
     def get(self, col, forceList=False):
         """
@@ -371,7 +945,7 @@ class queryData:
         """
         if col not in self.qHeader:
             raise ValueError('Column not found: {:s}'.format(col))
-        valList = [row[col] for row in self.data]
+        valList = [row[col] for row in self.fetch()]
 
         if (not forceList) and (len(valList) == 1):
             valList = valList[0]
@@ -395,10 +969,8 @@ class queryData:
         self.qHeader = [self.qHeader[i] for i in i_keep]
         self.qFormat = [self.qFormat[i] for i in i_keep]
 
-        for rDict in self.data:
-            for key in list(rDict):
-                if key not in keep:
-                    del rDict[key]
+        make = query_row_class(tuple(self.qHeader))._make
+        self.data = [make(tuple.__getitem__(row, i) for i in i_keep) for row in self.fetch()]
         return self
 
     def qFormat2str_only(self):
@@ -419,6 +991,7 @@ class queryData:
         """
         #  validate that number of header labels matches number of substitutions in format string and
         #  matches number of fields in data
+        self.fetch()
         if self.numCols() == 0:
             print('\nNo data\n')
             return
@@ -455,6 +1028,10 @@ class queryData:
                     d_fix.append(str(val))
                 elif isinstance(val, bool):
                     d_fix.append(str(val))
+                elif isinstance(val, str):
+                    # replace all non-ASCII characters with a "?"
+                    # just for printed output - no changes made to database
+                    d_fix.append(val.encode('ascii', 'replace').decode('ascii'))
                 else:
                     d_fix.append(val)
 
@@ -471,11 +1048,11 @@ class queryData:
 
     def count(self):
         """Number of rows (i.e. data entries) in the table"""
-        return len(self.data)
+        return len(self.fetch())
 
     def numCols(self):
         """Number of columns (i.e. fields) in the table"""
-        if self.data:
+        if self.fetch():
             return len(self.data[0].keys())
         else:
             return 0
@@ -487,65 +1064,1300 @@ class queryData:
 class timedomain():
 
     def __init__(self, cfgFile):
-        base = os.path.dirname(os.path.abspath(__file__))
-        self.cfg = ConfigObject(
-            file=os.path.join(base, 'usage', 'configs', cfgFile),
-            list_delimiter='&')
+        self.registry = load_query_registry(cfgFile=cfgFile)
+        self.cfg = self.registry.cfg
 
-    def query(self, basename, subs=None):
+    def query(self, basename, subs=None, itersize=None):
         """
         Run a query against a database and perform substitution into the query
         :param basename: basename of the query defined in the cfg file (cfg file has sections named 'Q_'+basename
         :param subs: dictionary of substitutions to make into query string (keys=string to replace, value=string to insert)
+        :param itersize: stream the rows, itersize per fetch (default: itersize of the Q_ section)
         :return: result of query
         """
         try:
             return queryData(
-                cfg=self.cfg,
+                registry=self.registry,
                 basename=basename,
-                subs=subs)
+                subs=subs,
+                itersize=itersize)
         except Exception as e:
             print(e)
 
 
-def augment_mmCIF(inputPath, outputPath):
+class afIDIndex:
+    """
+    In-memory (genome_id, protein_id) -> alpha.af_id id lookup, loaded once per run
+    """
+
+    def __init__(self, refresh_interval=None):
+        """
+        :param refresh_interval: seconds between incremental reloads of ids added since the last load (None never reloads)
+        """
+        self.ids = dict()
+        self.maxID = 0
+        self.refresh_interval = refresh_interval
+        self.lastRefresh = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self, rows):
+        """
+        Add rows of alpha.af_id to the index
+        :param rows: list of dictionaries with id, genome_id and protein_id keys
+        :return:
+        """
+        for row in rows:
+            self.ids[(row['genome_id'], row['protein_id'])] = row['id']
+            self.maxID = max(self.maxID, row['id'])
+
+    def refresh(self):
+        """
+        Load only the alpha.af_id rows inserted since the highest id already indexed
+        """
+        td = timedomain(cfgFile=cfgFile)
+        newRows = td.query(
+            basename='selectNew_afID',
+            subs={
+                "%%%MAXID%%%": self.maxID
+            }
+        ).data
+        self.load(rows=newRows)
+        self.lastRefresh = time.monotonic()
+
+    def get(self, genome_id, protein_id):
+        """
+        Return the alpha.af_id id of an AlphaFold model, or None if it has no entry
+        """
+        with self.lock:
+            if self.refresh_interval is not None and time.monotonic() - self.lastRefresh > self.refresh_interval:
+                self.refresh()
+            return self.ids.get((genome_id, protein_id))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class mappingIndex:
+    """
+    AlphaFold to BMRB mapping file (singleComplete.txt) parsed once into a lookup keyed by AlphaFold model name
+    """
+
+    def __init__(self, mappingFile, pdbTable=None):
+        """
+        :param mappingFile: flat file of AF to BMRB mappings, one "<AlphaFold .pdb path> ['<bmrb id>', ...]" per line
+        :param pdbTable: optional JSON sidecar of precomputed BMRB -> PDB ids, loaded if it exists
+        """
+        self.paths = OrderedDict()
+        self.bmrbIDs = OrderedDict()
+        self.pdbIDs = dict()
+        self.lock = threading.Lock()
+
+        with open(mappingFile) as file:
+            for line in file:
+                af_file_path = line.rstrip().split(' ')[0]
+                if not af_file_path:
+                    continue
+                model = os.path.splitext(os.path.basename(af_file_path))[0]
+                self.paths[model] = af_file_path
+                bmrb_id = self.bmrbIDs.setdefault(model, OrderedDict())
+                for entry in line.rstrip()[len(af_file_path):].split(','):
+                    tmp_id = ''.join(e for e in entry if e.isdigit())
+                    if tmp_id:
+                        bmrb_id[tmp_id] = None
+
+        if pdbTable and os.path.isfile(pdbTable):
+            with open(pdbTable) as jsp:
+                self.pdbIDs.update(json.load(jsp))
+
+    def bmrb_ids(self, af_id):
+        """
+        Return the deduplicated BMRB ids mapped to an AlphaFold model, in file order
+        :param af_id: AlphaFold model name, e.g. AF-O94312-F1-model_v1
+        :return: list
+        """
+        return list(self.bmrbIDs.get(af_id, ()))
+
+    def pdb_id(self, bmrbID):
+        """
+        Return the PDB id(s) of a BMRB entry, asking the BMRB only the first time an id is seen
+        """
+        with self.lock:
+            if bmrbID not in self.pdbIDs:
+                self.pdbIDs[bmrbID] = ''.join(bmrb2pdb_ID(bmrbID))
+            return self.pdbIDs[bmrbID]
+
+    def write_pdb_table(self, pdbTable):
+        """
+        Resolve the PDB ids of every BMRB id in the mapping file and save them as a JSON sidecar
+        :param pdbTable: path of the JSON file to write
+        :return:
+        """
+        for bmrbIDs in self.bmrbIDs.values():
+            for bmrbID in bmrbIDs:
+                self.pdb_id(bmrbID)
+        with open(pdbTable, 'w') as jsp:
+            json.dump(self.pdbIDs, jsp, indent=1, sort_keys=True)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class runJournal:
+    """
+    Append-only JSONL manifest of the state of every file of a run (running, done, failed).
+    The last record of a path is its current state, so an interrupted run can be resumed from it
+    """
+    # outcomes that are done but retried on resume: predictions may have been loaded since
+    retryStatuses = ('no_predictions',)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = dict()
+        self.status = dict()
+        self.lock = threading.Lock()
+
+        if os.path.isfile(filename):
+            with open(filename, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # last line of a run that died while writing it
+                        continue
+                    self.state[rec['path']] = rec['state']
+                    self.status[rec['path']] = rec.get('status')
+        self.file = open(filename, mode='a', encoding='utf-8')
+
+    def record(self, path, state, **fields):
+        """
+        Append the new state of a file to the journal
+        :param path: input path of the file
+        :param state: running, done or failed
+        :param fields: extra values to store with the record (status, af_entry_id, duration, error)
+        """
+        rec = OrderedDict([('time', datetime.datetime.now().isoformat(timespec='seconds')), ('path', path),
+                           ('state', state)])
+        rec.update(fields)
+        with self.lock:
+            self.file.write(json.dumps(rec) + '\n')
+            self.file.flush()
+            self.state[path] = state
+            self.status[path] = fields.get('status')
+
+    def record_result(self, result):
+        """
+        Record the outcome of augment_file: failed files are failed, every other outcome is done
+        """
+        state = 'failed' if result['status'] == 'failed' else 'done'
+        self.record(result['path'], state, status=result['status'], af_entry_id=result['af_entry_id'],
+                    duration=result['duration'], error=result['error'])
+
+    def incomplete(self, inputPaths):
+        """
+        Yield the paths whose last recorded state is not done, or is done with one of retryStatuses
+        """
+        for inputPath in inputPaths:
+            if self.state.get(inputPath) != 'done' or self.status.get(inputPath) in self.retryStatuses:
+                yield inputPath
+
+    def close(self):
+        self.file.close()
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile
+    :param values: sorted sequence of numbers
+    :param q: percentile, 0 to 100
+    :return: value, or None for an empty sequence
+    """
+    if not len(values):
+        return None
+    return values[max(int(-(-q * len(values) // 100)) - 1, 0)]
+
+
+class runMetrics:
+    """
+    Per-file stage timings and sizes of a run. Each augment_file result is appended to a JSONL log, and the
+    stage timings are kept (as arrays of doubles) for the end-of-run percentiles and the optional Prometheus
+    textfile, which is rewritten at most every promInterval seconds
+    """
+    quantiles = (50, 95, 99)
+
+    def __init__(self, logFile=None, promFile=None, promInterval=30.0):
+        self.start = time.monotonic()
+        self.startTime = time.time()
+        self.stages = OrderedDict((stage, array('d')) for stage in METRIC_STAGES)
+        self.status = defaultdict(int)
+        self.totals = defaultdict(int)
+        self.lock = threading.Lock()
+        self.log = open(logFile, mode='a', encoding='utf-8') if logFile else None
+        self.promFile = promFile
+        self.promInterval = promInterval
+        self.promWritten = self.start
+
+    def record(self, result):
+        """
+        Add the timings and sizes of one augment_file result
+        """
+        timings = result.get('timings') or {}
+        stats = result.get('stats') or {}
+        with self.lock:
+            self.status[result['status']] += 1
+            for stage, seconds in timings.items():
+                self.stages.setdefault(stage, array('d')).append(seconds)
+            for key, value in stats.items():
+                self.totals[key] += value
+            if self.log is not None:
+                rec = OrderedDict([('time', datetime.datetime.now().isoformat(timespec='seconds')),
+                                   ('path', result['path']), ('status', result['status']),
+                                   ('af_entry_id', result['af_entry_id'])])
+                rec.update(timings=timings, stats=stats)
+                self.log.write(json.dumps(rec) + '\n')
+                self.log.flush()
+            promDue = self.promFile and time.monotonic() - self.promWritten >= self.promInterval
+        if promDue:
+            self.write_prometheus()
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def summary(self):
+        """
+        Percentiles of every stage, in seconds, and the run throughput
+        :return: OrderedDict of stage -> OrderedDict(count, p50, p95, p99), and an OrderedDict of rates
+        """
+        with self.lock:
+            stages = OrderedDict()
+            for stage, values in self.stages.items():
+                if not values:
+                    continue
+                ordered = sorted(values)
+                stages[stage] = OrderedDict([('count', len(ordered)), ('sum', sum(ordered))])
+                stages[stage].update(('p{:d}'.format(q), percentile(ordered, q)) for q in self.quantiles)
+            elapsed = self.elapsed()
+            rates = OrderedDict([('elapsed', elapsed), ('files', sum(self.status.values())),
+                                 ('proteins_per_sec', self.status['done'] / elapsed if elapsed else 0.0),
+                                 ('atoms_per_sec', self.totals['atoms'] / elapsed if elapsed else 0.0)])
+        return stages, rates
+
+    def report(self):
+        stages, rates = self.summary()
+        print('{:d} files in {:.1f} s: {:.2f} proteins/s, {:.0f} atoms/s'.format(
+            rates['files'], rates['elapsed'], rates['proteins_per_sec'], rates['atoms_per_sec']))
+        for stage, values in stages.items():
+            print('stage {:<12} n={:<8d} {}'.format(stage, values['count'], ' '.join(
+                'p{:d}={:.4f}s'.format(q, values['p{:d}'.format(q)]) for q in self.quantiles)))
+        print('totals: {}'.format(', '.join('{}={}'.format(k, v) for k, v in sorted(self.totals.items()))))
+
+    def write_prometheus(self):
+        """
+        Write the metrics in the Prometheus text format, through a temp file renamed over promFile so the
+        node_exporter textfile collector never reads a partial file
+        """
+        stages, rates = self.summary()
+        with self.lock:
+            status = dict(self.status)
+            totals = dict(self.totals)
+            self.promWritten = time.monotonic()
+        lines = ['# HELP augment_files_total AlphaFold files processed, by status',
+                 '# TYPE augment_files_total counter']
+        lines.extend('augment_files_total{{status="{}"}} {:d}'.format(k, v) for k, v in sorted(status.items()))
+        lines.extend(['# HELP augment_stage_seconds Wall time of an augmentation stage per file',
+                      '# TYPE augment_stage_seconds summary'])
+        for stage, values in stages.items():
+            lines.extend('augment_stage_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                stage, q / 100, values['p{:d}'.format(q)]) for q in self.quantiles)
+            lines.append('augment_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, values['sum']))
+            lines.append('augment_stage_seconds_count{{stage="{}"}} {:d}'.format(stage, values['count']))
+        for key in sorted(totals):
+            lines.extend(['# TYPE augment_{}_total counter'.format(key),
+                          'augment_{}_total {:d}'.format(key, totals[key])])
+        lines.extend(['# HELP augment_proteins_per_second Augmented files per second since the start of the run',
+                      '# TYPE augment_proteins_per_second gauge',
+                      'augment_proteins_per_second {:.6f}'.format(rates['proteins_per_sec']),
+                      '# TYPE augment_run_start_time_seconds gauge',
+                      'augment_run_start_time_seconds {:.0f}'.format(self.startTime)])
+
+        tmpFilename = '{}.{}.tmp'.format(self.promFile, os.getpid())
+        with open(tmpFilename, mode='w', encoding='utf-8') as myfile:
+            myfile.write('\n'.join(lines) + '\n')
+        os.replace(tmpFilename, self.promFile)
+
+    def close(self):
+        if self.promFile:
+            self.write_prometheus()
+        if self.log is not None:
+            self.log.close()
+
+
+class slowFileProfiler:
+    """
+    Opt-in profiling of slow outliers. Every file is timed without a profiler, and a file that takes at least
+    threshold seconds, or longer than the given percentile of the recent files of the process, is run once more
+    under cProfile (and tracemalloc with memory=True). The profiles are written to directory as <model>.pstats
+    (and a <model>.tracemalloc snapshot of the memory the file still holds at the end, with its peak).
+    tracemalloc is process-global, so profiled files must not run alongside others in the same process: each
+    --workers process re-runs its own outliers one at a time, and --pipeline cannot be profiled
+    """
+
+    def __init__(self, directory, threshold=None, percentile=None, minSamples=20, window=1000, memory=False,
+                 frames=10):
+        self.directory = directory
+        self.threshold = threshold
+        self.percentile = percentile
+        self.minSamples = minSamples
+        self.memory = memory
+        self.frames = frames
+        self.recent = deque(maxlen=window)
+        # outliers reported back by record(), in the process running the run
+        self.outliers = []
+
+    def cutoff(self):
+        """
+        Duration above which a file is an outlier, None while there is none
+        """
+        limits = []
+        if self.threshold is not None:
+            limits.append(self.threshold)
+        if self.percentile is not None and len(self.recent) >= self.minSamples:
+            limits.append(percentile(sorted(self.recent), self.percentile))
+        return min(limits) if limits else None
+
+    def is_outlier(self, elapsed):
+        """
+        Add the duration of an unprofiled file to the recent files and tell whether it is a slow outlier
+        """
+        cutoff = self.cutoff()
+        self.recent.append(elapsed)
+        return cutoff is not None and elapsed >= cutoff
+
+    @contextmanager
+    def capture(self, job, elapsed):
+        """
+        Profile the stages re-run inside the block and return the profile of the outlier in job.result['profile'].
+        The job data is still referenced here, so the snapshot shows what the file holds in memory. Tracing
+        starts and stops with the block (unless it was already on), so the peak is the peak of this file
+        :param elapsed: unprofiled duration of the file
+        """
+        tracing = tracemalloc.is_tracing()
+        if self.memory:
+            if tracing:
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start(self.frames)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            try:
+                self.save(job=job, profiler=profiler, elapsed=elapsed)
+            finally:
+                if self.memory and not tracing:
+                    tracemalloc.stop()
+
+    def save(self, job, profiler, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        model = job.af_id or cif_model_name(job.inputPath)
+        profile = OrderedDict([('model', model), ('seconds', elapsed),
+                               ('profiled_seconds', time.monotonic() - job.start),
+                               ('pstats', os.path.join(self.directory, model + '.pstats'))])
+        profiler.dump_stats(profile['pstats'])
+        if self.memory:
+            profile['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            profile['tracemalloc'] = os.path.join(self.directory, model + '.tracemalloc')
+            tracemalloc.take_snapshot().dump(profile['tracemalloc'])
+        job.result['profile'] = profile
+
+    def record(self, result):
+        """
+        Keep the profile of an outlier result for the report
+        """
+        if result.get('profile'):
+            self.outliers.append(result['profile'])
+
+    def report(self, top=20, functions=3):
+        """
+        Print the slowest profiled files with the functions they spent the most time in, and write the same
+        ranking to slow_files.txt in the profile directory
+        """
+        if not self.outliers:
+            return
+        lines = ['{:d} slow files profiled in {}'.format(len(self.outliers), self.directory)]
+        for rank, profile in enumerate(sorted(self.outliers, key=lambda p: -p['seconds'])[:top], start=1):
+            peak = ', peak {:.1f} MB'.format(profile['peak_bytes'] / 2 ** 20) if 'peak_bytes' in profile else ''
+            lines.append('{:3d}. {} {:.2f} s{} ({})'.format(rank, profile['model'], profile['seconds'], peak,
+                                                          profile['pstats']))
+            try:
+                stats = pstats.Stats(profile['pstats']).stats
+            except (OSError, ValueError, EOFError):
+                continue
+            worst = sorted(stats.items(), key=lambda item: -item[1][2])[:functions]
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in worst:
+                lines.append('       {:8.3f} s own {:8.3f} s cum {:>9d} calls  {} ({}:{:d})'.format(
+                    tottime, cumtime, calls, name, os.path.basename(filename), line))
+        print('\n'.join(lines))
+        with open(os.path.join(self.directory, 'slow_files.txt'), mode='w', encoding='utf-8') as myfile:
+            myfile.write('\n'.join(lines) + '\n')
+
+
+class chemicalShiftIndex:
+    """
+    Hashed lookup of standardized chemical shifts keyed by (csp_id, res_sequence, atom)
+    """
+
+    def __init__(self):
+        self.shifts = dict()
+        self.cspIDs = []
+
+    def add(self, cspID, rows):
+        """
+        Index the rows returned by Q_compareCSP for one chemical shift predictor
+        :param cspID: chemical shift predictor id
+        :param rows: list of dictionaries with res_sequence, atom and chemical_shift keys
+        :return:
+        """
+        if cspID not in self.cspIDs:
+            self.cspIDs.append(cspID)
+        for row in rows:
+            # rows are ordered by res_sequence, a repeated (residue, atom) keeps the last shift
+            self.shifts[(cspID, row['res_sequence'], row['atom'])] = row['chemical_shift']
+
+    def get(self, cspID, resNum, atom):
+        """
+        Return the chemical shift predicted for an atom, or None if the predictor has no value for it
+        """
+        return self.shifts.get((cspID, resNum, atom))
+
+    def keys(self):
+        """
+        Return the chemical shift predictor ids held in the index, in query order
+        :return: list
+        """
+        return list(self.cspIDs)
+
+    def __contains__(self, cspID):
+        return cspID in self.cspIDs
+
+
+class atomNamingIndex:
+    """
+    alpha.atom_naming loaded once per run: the standard names of a predictor's atoms keyed by
+    (csp_id, res_name, protein_atom). Like the atom_naming join of Q_compareCSP, which matches on res_name and
+    protein_atom only, the names listed for any predictor apply to every predictor of alpha.cs_predictor
+    """
+
+    def __init__(self, namingRows, predictorRows):
+        """
+        :param namingRows: rows of Q_selectAll_atomNaming (csp_id, res_name, protein_atom, atom_std)
+        :param predictorRows: rows of Q_selectAll_cspID (id, csp_name)
+        """
+        self.predictors = OrderedDict((row['id'], row['csp_name']) for row in predictorRows)
+        byAtom = OrderedDict()
+        for row in namingRows:
+            # a NULL atom_std keeps the predictor's own name
+            byAtom.setdefault((row['res_name'], row['protein_atom']), []).append(row['atom_std'] or row['protein_atom'])
+        self.names = dict()
+        for cspID in self.predictors:
+            for (resName, atom), names in byAtom.items():
+                self.names[(cspID, resName, atom)] = tuple(dict.fromkeys(names))
+
+    @classmethod
+    def load(cls, cfgFile):
+        td = timedomain(cfgFile=cfgFile)
+        return cls(namingRows=td.query(basename='selectAll_atomNaming').data,
+                   predictorRows=td.query(basename='selectAll_cspID').data)
+
+    def standard_atoms(self, cspID, resName, atom):
+        """
+        Return the standard names of a predicted atom, its own name when atom_naming has none
+        :return: tuple of atom names
+        """
+        return self.names.get((cspID, resName, atom), (atom,))
+
+
+STD_ROW = query_row_class(('res_sequence', 'residue_type', 'atom', 'chemical_shift'))
+
+
+def standardize_predictions(cspID, rawRows, residueTypes, naming):
+    """
+    Standardize the raw predictions of one protein and predictor the way Q_compareCSP does: every row under the
+    standard atom names, residues whose predicted type differs from the model (e.g. SHIFTX2's ASX for ASP/ASN)
+    under the model's residue type, and ASX rows only under the model's type
+    :param cspID: chemical shift predictor id
+    :param rawRows: alpha.cs_prediction rows with res_sequence, res_name, protein_atom and chemical_shift
+    :param residueTypes: dictionary of residue_sequence -> residue types of the model at that position
+    :param naming: atomNamingIndex
+    :return: list of records with res_sequence, residue_type, atom and chemical_shift, ordered by res_sequence
+    """
+    rows = OrderedDict()
+    for raw in rawRows:
+        resSeq = raw['res_sequence']
+        resName = raw['res_name']
+        shift = raw['chemical_shift']
+        for atom in naming.standard_atoms(cspID, resName, raw['protein_atom']):
+            if resName is not None and resName != 'ASX':
+                rows.setdefault((resSeq, resName, atom, shift))
+            for residueType in residueTypes.get(resSeq, ()):
+                if resName is not None and residueType != resName:
+                    rows.setdefault((resSeq, residueType, atom, shift))
+    return [STD_ROW._make(row) for row in sorted(rows, key=lambda row: row[0])]
+
+
+# gzip level of compressed outputs, the size gain of the higher levels is small for the time they take
+GZIP_LEVEL = 6
+CIF_EXTENSIONS = ('.cif', '.cif.gz')
+
+
+def open_cif(filename, mode='rt', gz=None):
+    """
+    Open a plain or gzip compressed (also bgzip, which is multi-member gzip) mmCIF file as text.
+    Compressed files are decompressed while they are read
+    :param filename: path of the file
+    :param mode: 'rt' or 'wt'
+    :param gz: compressed or not, by default when filename ends in .gz
+    :return: text file object
+    """
+    if gz is None:
+        gz = filename.endswith('.gz')
+    if gz:
+        return gzip.open(filename, mode=mode, encoding='utf-8', compresslevel=GZIP_LEVEL)
+    return open(filename, mode=mode, encoding='utf-8')
+
+
+def cif_model_name(filename):
+    """
+    Model name of an mmCIF path, e.g. AF-O94312-F1-model_v1 for .../AF-O94312-F1-model_v1.cif.gz
+    """
+    name = os.path.basename(filename)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return os.path.splitext(name)[0]
+
+
+class augmentedDocument:
+    """
+    Augmented mmCIF file assembled in memory and written once through a temp file and rename.
+    Supports write() so the writers can print(..., file=doc) as they would to a file opened in append mode
+    """
+
+    def __init__(self):
+        # complete lines (each ending in a newline) and the text written after the last newline
+        self.lines = []
+        self.tail = ''
+
+    def write(self, text):
+        lines = text.split('\n')
+        lines[0] = self.tail + lines[0]
+        self.tail = lines.pop()
+        self.lines.extend(line + '\n' for line in lines)
+        return len(text)
+
+    def readlines(self):
+        """
+        Return the document as a list of lines, the same as readlines() on the written file
+        :return: list
+        """
+        if self.tail:
+            return self.lines + [self.tail]
+        return list(self.lines)
+
+    def last_line(self):
+        if self.tail:
+            return self.tail
+        if self.lines:
+            return self.lines[-1]
+        return ''
+
+    def clear(self):
+        self.lines = []
+        self.tail = ''
+
+    def save(self, filename):
+        """
+        Write the document to filename in one pass. The text goes to a temp file in the same directory
+        which is renamed over filename, so filename is either absent or complete. A filename ending in .gz
+        is written gzip compressed
+        :param filename: path of the augmented mmCIF file
+        :return: number of characters written
+        """
+        tmpFilename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+        try:
+            with open_cif(tmpFilename, mode='wt', gz=filename.endswith('.gz')) as myfile:
+                myfile.writelines(self.lines)
+                myfile.write(self.tail)
+            os.replace(tmpFilename, filename)
+        except BaseException:
+            try:
+                os.remove(tmpFilename)
+            except OSError:
+                pass
+            raise
+        return sum(len(line) for line in self.lines) + len(self.tail)
+
+
+class atomSiteSidecar:
+    """
+    Columnar copy of the augmented _atom_site loop of one model, for analysis without parsing the mmCIF text.
+    Columns are named after the _atom_site items they hold; coordinates and shifts missing from the text
+    ('?' and '.') are NaN
+    """
+
+    FORMATS = ('npz', 'parquet')
+
+    def __init__(self, model, cspList):
+        """
+        :param model: AlphaFold model name, e.g. AF-O94312-F1-model_v1
+        :param cspList: chemical shift predictor ids, one shift column each
+        """
+        self.model = model
+        self.cspList = list(cspList)
+        self.columns = OrderedDict([('id', array('l')), ('label_atom_id', []), ('label_comp_id', []),
+                                    ('type_symbol', []), ('residue_number', array('l')),
+                                    ('cartn_x', array('d')), ('cartn_y', array('d')), ('cartn_z', array('d')),
+                                    ('cartn_x_protonated_1', array('d')), ('cartn_y_protonated_1', array('d')),
+                                    ('cartn_z_protonated_1', array('d')), ('b_iso_or_equiv', array('d'))])
+        for cspID in self.cspList:
+            self.columns['chemical_shift_predictor_{}'.format(cspID)] = array('d')
+
+    def add(self, atomId, atomName, resName, element, resNum, coords, protonated, bFactor, shifts):
+        """
+        Append one atom
+        :param coords: model (x, y, z), NaN for atoms added by REDUCE
+        :param protonated: (x, y, z) after protonation
+        :param shifts: one shift per predictor of cspList, NaN where there is none
+        """
+        values = [int(atomId), atomName, resName, element, int(resNum)]
+        values.extend(coords)
+        values.extend(protonated)
+        values.append(bFactor)
+        values.extend(shifts)
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def save(self, filename, fmt='npz'):
+        """
+        Write the columns to filename through a temp file renamed into place, like augmentedDocument.save.
+        npz holds one array per column and the model name; parquet adds the model as a column, so the
+        sidecars of a proteome directory read as one dataset
+        :param filename: destination path
+        :param fmt: npz or parquet
+        """
+        tmpFilename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+        try:
+            if fmt == 'npz':
+                arrays = {name: np.asarray(column) for name, column in self.columns.items()}
+                with open(tmpFilename, mode='wb') as myfile:
+                    np.savez(myfile, model=np.array(self.model), **arrays)
+            elif fmt == 'parquet':
+                data = OrderedDict([('model', pyarrow.array([self.model] * len(self)).dictionary_encode())])
+                data.update((name, pyarrow.array(column)) for name, column in self.columns.items())
+                pq.write_table(pyarrow.table(data), tmpFilename)
+            else:
+                raise ValueError('unknown sidecar format {}'.format(fmt))
+            os.replace(tmpFilename, filename)
+        except BaseException:
+            try:
+                os.remove(tmpFilename)
+            except OSError:
+                pass
+            raise
+
+
+# chemical shifts fetched ahead of the writers by prefetch_cs_predictions, keyed by af_id
+csPrefetch = dict()
+prefetch_size = 0
+# (genome_id, protein_id) -> af_id index built by main, None queries Q_afID_Index per file
+afIndex = None
+# mapping file index, built by main or on first use from mapping_file
+mapIndex = None
+# directory of cached directory listings used by searchPathExt, None lists every directory
+dir_index = None
+# runJournal of the run, and whether files the journal has as done are skipped without checking their output
+journal = None
+resume = False
+# write augmented files gzip compressed (.cif.gz)
+compress_output = False
+# format of the columnar sidecar written next to each augmented file (npz or parquet), None writes none
+sidecar_format = None
+# where standardized chemical shifts come from: the Q_compareCSP join run per batch (query), the
+# precomputed alpha.cs_prediction_std table (table) or raw predictions standardized in Python (client)
+SHIFT_SOURCES = OrderedDict([('query', 'compareCSP_batch'), ('table', 'selectStdPredictions_batch'),
+                             ('client', 'selectRawPredictions_batch')])
+DEFAULT_SHIFT_SOURCE = 'query'
+shift_source = DEFAULT_SHIFT_SOURCE
+# atomNamingIndex of the client shift source, loaded on first use
+atomNaming = None
+# runMetrics of the parent process (None in pool workers)
+metrics = None
+# slowFileProfiler of --profileDir, None leaves files unprofiled
+profiler = None
+# threads per stage when files are augmented in a pipeline (None runs them one file at a time)
+pipeline_stages = None
+pipeline_queue_depth = None
+
+
+def augment_mmCIF(inputPath, outputPath, workers=1):
     if os.path.isfile(inputPath):
-        uniprot_id, af_id = reboxitoryPath_to_uniprotAF(inputPath)
-        af_entry_id = check_for_cs_predictions(uniprot_id=uniprot_id, af_id=af_id)
-        if af_entry_id:
-            base = os.path.basename(inputPath)
-            newBase = base.replace('.cif', '_augmented.cif')
-            outputFile = os.path.join(outputPath, newBase)
-            # try:
-            #     os.remove(outputFile)
-            # except OSError:
-            #     pass
-            checkFile = Path(outputFile)
-            if checkFile.is_file():
-                return
-                # os.remove(outputFile)
+        augment_paths(inputPaths=[inputPath], outputPath=outputPath)
+    elif os.path.isdir(inputPath):
+        listInputAF = searchPathExt(inputPath=inputPath, indexCache=dir_index)
+        augment_paths(inputPaths=listInputAF, outputPath=outputPath, workers=workers)
+
+
+def augment_paths(inputPaths, outputPath, workers=1):
+    """
+    Augment a list of AlphaFold mmCIF files, serially, in a pool of worker processes or in a thread pipeline
+    """
+    if journal is not None and resume:
+        inputPaths = journal.incomplete(inputPaths)
+    if workers > 1:
+        augment_parallel(inputPaths=inputPaths, outputPath=outputPath, workers=workers)
+        return
+    if pipeline_stages is not None:
+        augment_pipeline(inputPaths=inputPaths, outputPath=outputPath, stageWorkers=pipeline_stages,
+                         queueDepth=pipeline_queue_depth)
+        return
+    for chunk in chunked(inputPaths, size=max(prefetch_size, 1)):
+        if journal is not None:
+            for inputPath in chunk:
+                journal.record(inputPath, 'running')
+        for result in augment_chunk(inputPaths=chunk, outputPath=outputPath):
+            record_result(result=result)
+            report_result(result=result)
+
+
+def mapped_cif_paths(afPath):
+    """
+    Resolve the models of the mapping file to their .cif siblings under afPath without walking the tree.
+    Each proteome directory is listed once and only the models present in it are returned
+    :param afPath: root of the AlphaFold snapshot, e.g. /reboxitory/2021/07/alphafold
+    :return: list of .cif (or .cif.gz) paths in mapping file order
+    """
+    byDir = OrderedDict()
+    for model, af_file_path in mapIndex.paths.items():
+        proteome = os.path.basename(os.path.dirname(af_file_path))
+        byDir.setdefault(os.path.join(afPath, proteome), []).append(model)
+
+    cifPaths = []
+    missing = 0
+    for dirname, names in byDir.items():
+        try:
+            present = set(os.listdir(dirname))
+        except FileNotFoundError:
+            present = set()
+        for model in names:
+            for ext in CIF_EXTENSIONS:
+                if model + ext in present:
+                    cifPaths.append(os.path.join(dirname, model + ext))
+                    break
+            else:
+                missing += 1
+    print('{:d} of {:d} mapped models found under {:s}'.format(len(cifPaths), len(mapIndex), afPath))
+    if missing:
+        print('{:d} mapped models have no .cif file'.format(missing))
+    return cifPaths
+
+
+class augmentJob:
+    """
+    One AlphaFold file moving through the augmentation stages (lookup, fetch, parse, format, write), with the
+    data each stage hands to the next
+    """
+    # ids resolved by the lookup stage, kept after finish()
+    ID_SLOTS = ('uniprot_id', 'af_id')
+    # data handed from stage to stage, dropped by finish()
+    DATA_SLOTS = ('outputFile', 'csDict', 'afH_atoms', 'number_residues', 'headerText', 'cifDict', 'doc', 'sidecar')
+    __slots__ = ('inputPath', 'outputPath', 'overwrite', 'start', 'result', 'timings', 'stats') + ID_SLOTS + \
+        DATA_SLOTS
+
+    def __init__(self, inputPath, outputPath, overwrite=False):
+        """
+        :param overwrite: write the output even if it exists (the profiled re-run of a file just written)
+        """
+        self.inputPath = inputPath
+        self.outputPath = outputPath
+        self.overwrite = overwrite
+        self.start = time.monotonic()
+        self.result = OrderedDict([('path', inputPath), ('status', None), ('af_entry_id', None), ('duration', None),
+                                   ('error', None)])
+        self.timings = OrderedDict()
+        self.stats = OrderedDict()
+        for name in self.ID_SLOTS + self.DATA_SLOTS:
+            setattr(self, name, None)
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Add the wall time of the block to the timing of a stage (one of METRIC_STAGES)
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.monotonic() - start
+
+    def finish(self):
+        """
+        Close the job: a job no stage has stopped is done. The timings and stats go into the result, the stage
+        data is dropped
+        :return: augment_file result
+        """
+        if self.result['status'] is None:
+            self.result['status'] = 'done'
+        self.result['duration'] = time.monotonic() - self.start
+        self.timings['total'] = self.result['duration']
+        self.result['timings'] = self.timings
+        self.result['stats'] = self.stats
+        for name in self.DATA_SLOTS:
+            setattr(self, name, None)
+        return self.result
+
+
+def lookup_stage(job):
+    """
+    Resolve the af_id of the file, stopping the job when it has no predictions or is already augmented
+    """
+    with job.timed('lookup'):
+        job.uniprot_id, job.af_id = reboxitoryPath_to_uniprotAF(job.inputPath)
+        af_entry_id = check_for_cs_predictions(uniprot_id=job.uniprot_id, af_id=job.af_id)
+    job.result['af_entry_id'] = af_entry_id or None
+    if not af_entry_id:
+        job.result['status'] = 'no_predictions'
+        return
+
+    newBase = job.af_id + ('_augmented.cif.gz' if compress_output else '_augmented.cif')
+    job.outputFile = os.path.join(job.outputPath, newBase)
+    # a resumed run takes the journal's word for what is done, anything else is written again
+    if not resume and not job.overwrite and Path(job.outputFile).is_file():
+        job.result['status'] = 'skipped'
+
+
+def fetch_stage(job):
+    """
+    Run the database queries of the file: chemical shifts, protonated atoms and residue count
+    """
+    af_entry_id = job.result['af_entry_id']
+    with job.timed('shift_query'):
+        job.csDict = queeryCS_to_dictionary(af_entry_id)
+    with job.timed('coord_query'):
+        # a streamed query is read here, so later stages do not hold a connection
+        job.afH_atoms = list(query_afH_atoms(af_id=af_entry_id))
+        job.number_residues = count_residues(af_entry_id)
+    job.stats['atoms'] = len(job.afH_atoms)
+    job.stats['predictors'] = len(job.csDict.keys())
+
+
+def parse_stage(job):
+    """
+    Read the header of the original file and parse its _atom_site loop
+    """
+    with job.timed('parse'):
+        job.headerText = read_orig_cif_header(orig_cifFile=job.inputPath, af_id=job.af_id)
+        job.cifDict = read_model_cif(af_file=job.inputPath, af_entry_name=job.af_id)
+
+
+def format_stage(job):
+    """
+    Assemble the augmented document (and sidecar) in memory
+    """
+    # every section is assembled in memory, outputFile is only created once the document is complete
+    doc = augmentedDocument()
+    job.sidecar = atomSiteSidecar(model=job.af_id, cspList=cspID_list) if sidecar_format else None
+    with job.timed('atom_site'):
+        print_ascension_ids(doc=doc, af_id=job.af_id, uniprot_id=job.uniprot_id)
+        doc.write(job.headerText)
+        print_aug_atom_site(af_file=job.inputPath, csDict=job.csDict, doc=doc, af_id=job.result['af_entry_id'],
+                            af_entry_name=job.af_id, sidecar=job.sidecar, cifDict=job.cifDict,
+                            afH_atoms=job.afH_atoms, number_residues=job.number_residues)
+    with job.timed('software'):
+        print_software(csDict=job.csDict, doc=doc)
+        print_authorList(doc=doc)
+    job.doc = doc
+
+
+def write_stage(job):
+    """
+    Write the sidecar and then the augmented file, whose presence marks the model as done
+    """
+    with job.timed('write'):
+        if job.sidecar is not None:
+            sidecarPath = os.path.join(job.outputPath, 'sidecar', job.uniprot_id)
+            os.makedirs(sidecarPath, exist_ok=True)
+            job.sidecar.save(os.path.join(sidecarPath, '{}.{}'.format(job.af_id, sidecar_format)),
+                             fmt=sidecar_format)
+        job.doc.save(job.outputFile)
+    job.stats['output_bytes'] = os.path.getsize(job.outputFile)
+
+
+AUGMENT_STAGES = OrderedDict([('lookup', lookup_stage), ('fetch', fetch_stage), ('parse', parse_stage),
+                              ('format', format_stage), ('write', write_stage)])
+# threads per stage of augment_pipeline, fetch waits on the database and gets the most
+PIPELINE_WORKERS = OrderedDict([('lookup', 1), ('fetch', 4), ('parse', 2), ('format', 1), ('write', 2)])
+PIPELINE_QUEUE_DEPTH = 16
+# per-file timings recorded by the stages, in the order they are reported
+METRIC_STAGES = ('lookup', 'shift_query', 'coord_query', 'parse', 'atom_site', 'software', 'write', 'total')
+
+
+def run_stage(job, stage):
+    """
+    Run one stage of a job, recording the traceback of a failure
+    :return: True if the job goes on to the next stage
+    """
+    try:
+        stage(job)
+    except Exception:
+        job.result['status'] = 'failed'
+        job.result['error'] = traceback.format_exc()
+    return job.result['status'] is None
+
+
+def run_stages(job):
+    """
+    Run the stages of a job in sequence until one stops it
+    """
+    for stage in AUGMENT_STAGES.values():
+        if not run_stage(job, stage):
+            break
+
+
+def augment_file(inputPath, outputPath):
+    """
+    Write the augmented mmCIF file of a single AlphaFold model, running its stages in sequence
+    :param inputPath: path to an AlphaFold mmCIF file
+    :param outputPath: destination directory of the augmented file
+    :return: OrderedDict with path, status (done, skipped, no_predictions or failed), af_entry_id,
+             duration (s), error (traceback of a failed file), timings, stats and, for a profiled outlier,
+             profile
+    """
+    job = augmentJob(inputPath=inputPath, outputPath=outputPath)
+    run_stages(job)
+    result = job.finish()
+    # only a file that wrote its output is run again, rewriting the same output under the profiler
+    if profiler is not None and profiler.is_outlier(result['duration']) and result['status'] == 'done':
+        rerun = augmentJob(inputPath=inputPath, outputPath=outputPath, overwrite=True)
+        with profiler.capture(rerun, elapsed=result['duration']):
+            run_stages(rerun)
+        result['profile'] = rerun.result['profile']
+    return result
+
+
+def augment_chunk(inputPaths, outputPath):
+    """
+    Augment a batch of files, fetching their chemical shifts in one query first when prefetching is enabled
+    :return: list of augment_file results, in input order
+    """
+    try:
+        if prefetch_size:
             try:
-                print_ascension_ids(augmented_cifFilename=outputFile, af_id=af_id, uniprot_id=uniprot_id)
-                print_orig_cif(orig_cifFile=inputPath, augmented_cifFilename=outputFile, af_id=af_id)
-
-                csDictionary = queeryCS_to_dictionary(af_entry_id)
-                print_aug_atom_site(af_file=inputPath, csDict=csDictionary, augmented_csFilename=outputFile,
-                                    af_id=af_entry_id, af_entry_name=af_id)
-                print_software(csDict=csDictionary, augmented_csFilename=outputFile)
-                print_authorList(augmented_csFilename=outputFile)
-            except:
-                print(af_entry_id)
-                try:
-                    os.remove(outputFile)
-                except OSError:
+                prefetch_cs_predictions(inputPaths=inputPaths)
+            except Exception:
+                # each file then fetches its own shifts and reports its own error
+                traceback.print_exc()
+        return [augment_file(inputPath=inputPath, outputPath=outputPath) for inputPath in inputPaths]
+    finally:
+        # drop shifts of files that were skipped (already augmented)
+        csPrefetch.clear()
+
+
+def record_result(result):
+    """
+    Store the outcome of one file in the run journal, the run metrics and the outlier profiles, when they are
+    enabled
+    :param result: augment_file result
+    """
+    if journal is not None:
+        journal.record_result(result)
+    if metrics is not None:
+        metrics.record(result)
+    if profiler is not None:
+        profiler.record(result)
+
+
+def report_result(result, progress=None):
+    """
+    Print the outcome of one file, with the traceback of a failed file
+    :param result: augment_file result
+    :param progress: optional prefix such as the running file count
+    """
+    prefix = '{} '.format(progress) if progress else ''
+    if result['status'] == 'failed':
+        print('{}failed {} (af_id {}) after {:.2f} s\n{}'.format(
+            prefix, result['path'], result['af_entry_id'], result['duration'] or 0, result['error']))
+    elif result['status'] == 'done' or progress:
+        print('{}{} {} {:.2f} s'.format(prefix, result['status'], result['path'], result['duration'] or 0))
+
+
+def worker_settings():
+    """
+    Module state a pool worker needs to augment files on its own, shipped once per worker process
+    :return: dictionary
+    """
+    return dict(cfgFile=cfgFile, cspID_list=cspID_list, mapping_file=mapping_file, prefetch_size=prefetch_size,
+                afIndex=afIndex, mapIndex=mapIndex, resume=resume, compress_output=compress_output,
+                sidecar_format=sidecar_format, shift_source=shift_source,
+                atomNaming=atomNaming, profiler=profiler)
+
+
+def init_worker(settings):
+    """
+    Process pool initializer: install the run settings and reference data, and start with no database
+    sessions so each worker opens its own
+    """
+    global cfgFile, cspID_list, mapping_file, prefetch_size, afIndex, mapIndex, resume, compress_output, \
+        sidecar_format, shift_source, atomNaming, journal, metrics, profiler
+    cfgFile = settings['cfgFile']
+    cspID_list = settings['cspID_list']
+    mapping_file = settings['mapping_file']
+    prefetch_size = settings['prefetch_size']
+    afIndex = settings['afIndex']
+    mapIndex = settings['mapIndex']
+    resume = settings['resume']
+    compress_output = settings['compress_output']
+    sidecar_format = settings['sidecar_format']
+    shift_source = settings['shift_source']
+    atomNaming = settings['atomNaming']
+    # each worker judges outliers against its own recent files and returns their profiles with the results
+    profiler = settings['profiler']
+    # only the parent process writes the journal and the metrics
+    journal = None
+    metrics = None
+    connectionPools.clear()
+
+
+def augment_parallel(inputPaths, outputPath, workers, max_in_flight=None):
+    """
+    Augment files in a pool of worker processes. Results are reported in input order as they complete, and at
+    most max_in_flight batches are queued or held back waiting for an earlier batch, so one slow batch does not
+    let finished results pile up in memory
+    :param inputPaths: iterable of AlphaFold mmCIF paths
+    :param outputPath: destination directory of the augmented files
+    :param workers: number of worker processes
+    :param max_in_flight: maximum number of submitted or unreported batches (default 2 per worker)
+    :return: dictionary of status -> number of files
+    """
+    max_in_flight = max_in_flight or 2 * workers
+    counts = defaultdict(int)
+    # workers open their own connections, do not let them inherit the ones of this process
+    for pool in connectionPools.values():
+        pool.closeall()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(worker_settings(),)) as executor:
+        chunks = enumerate(chunked(inputPaths, size=max(prefetch_size, 1)))
+        pending = dict()
+        completed = dict()
+        nextChunk = 0
+        fileCount = 0
+
+        def submit():
+            # completed batches waiting for an earlier one count against the limit until they are reported
+            while len(pending) + len(completed) < max_in_flight:
+                chunkNum, chunk = next(chunks, (None, None))
+                if chunk is None:
                     return
-    elif os.path.isdir(inputPath):
-        listInputAF = searchPathExt(inputPath=inputPath)
-        for afFile in listInputAF:
-            augment_mmCIF(inputPath=afFile, outputPath=outputPath)
+                if journal is not None:
+                    for inputPath in chunk:
+                        journal.record(inputPath, 'running')
+                pending[executor.submit(augment_chunk, chunk, outputPath)] = (chunkNum, chunk)
+
+        submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunkNum, chunk = pending.pop(future)
+                try:
+                    completed[chunkNum] = future.result()
+                except Exception:
+                    # the worker itself died, record every file of the batch as failed
+                    error = traceback.format_exc()
+                    completed[chunkNum] = [OrderedDict([('path', path), ('status', 'failed'), ('af_entry_id', None),
+                                                        ('duration', None), ('error', error)]) for path in chunk]
+            while nextChunk in completed:
+                for result in completed.pop(nextChunk):
+                    record_result(result=result)
+                    fileCount += 1
+                    counts[result['status']] += 1
+                    report_result(result=result, progress='[{:d}]'.format(fileCount))
+                nextChunk += 1
+            submit()
+
+    print('augmented {:d} files: {}'.format(
+        fileCount, ', '.join('{}={}'.format(k, v) for k, v in sorted(counts.items()))))
+    return counts
+
+
+class pipelineStage:
+    """
+    Pool of threads running one augmentation stage on the jobs of a bounded inbox queue. Jobs that pass go on to
+    the outbox (blocking while it is full), jobs a stage stops or fails, and those leaving the last stage, go to
+    the done queue
+    """
+
+    def __init__(self, name, stage, workers, inbox, outbox, done):
+        self.name = name
+        self.stage = stage
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.done = done
+        self.threads = []
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+        self.depthMax = 0
+        self.depthSum = 0
+
+    def start(self):
+        for num in range(self.workers):
+            thread = threading.Thread(target=self.run, name='{}-{:d}'.format(self.name, num), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            depth = self.inbox.qsize()
+            job = self.inbox.get()
+            waited = time.monotonic() - start
+            if job is None:
+                with self.lock:
+                    self.idle += waited
+                return
+            start = time.monotonic()
+            passed = run_stage(job, self.stage)
+            busy = time.monotonic() - start
+            start = time.monotonic()
+            if passed and self.outbox is not None:
+                self.outbox.put(job)
+            else:
+                self.done.put(job)
+            with self.lock:
+                self.items += 1
+                self.idle += waited
+                self.busy += busy
+                self.blocked += time.monotonic() - start
+                self.depthMax = max(self.depthMax, depth)
+                self.depthSum += depth
+
+    def stop(self):
+        """
+        Let the workers finish the queued jobs and exit
+        """
+        for _ in self.threads:
+            self.inbox.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def metrics(self):
+        with self.lock:
+            return OrderedDict([('workers', self.workers), ('items', self.items),
+                                ('busy', '{:.2f}s'.format(self.busy)), ('idle', '{:.2f}s'.format(self.idle)),
+                                ('blocked', '{:.2f}s'.format(self.blocked)), ('queue_max', self.depthMax),
+                                ('queue_mean', '{:.1f}'.format(self.depthSum / self.items if self.items else 0))])
+
+
+def augment_pipeline(inputPaths, outputPath, stageWorkers=None, queueDepth=None):
+    """
+    Augment files in a staged pipeline of thread pools (lookup, fetch, parse, format, write) joined by bounded
+    queues, so database round trips, parsing and writing of different files overlap. A full queue holds back
+    the stage feeding it. Results are reported as files complete
+    :param inputPaths: iterable of AlphaFold mmCIF paths
+    :param outputPath: destination directory of the augmented files
+    :param stageWorkers: dictionary of stage name -> number of threads (default PIPELINE_WORKERS)
+    :param queueDepth: capacity of each queue between stages
+    :return: dictionary of status -> number of files
+    """
+    workers = OrderedDict(PIPELINE_WORKERS)
+    workers.update(stageWorkers or {})
+    queueDepth = queueDepth or PIPELINE_QUEUE_DEPTH
+    done = queue.Queue()
+    inboxes = [queue.Queue(maxsize=queueDepth) for _ in AUGMENT_STAGES]
+    stages = [pipelineStage(name=name, stage=stage, workers=workers[name], inbox=inboxes[num],
+                            outbox=inboxes[num + 1] if num + 1 < len(inboxes) else None, done=done)
+              for num, (name, stage) in enumerate(AUGMENT_STAGES.items())]
+    for stage in stages:
+        stage.start()
+
+    discoverMetrics = dict(items=0, blocked=0.0)
+    # an error listing the input files, raised again in this thread once the files already queued are done
+    discoverErrors = []
+
+    def discover():
+        try:
+            for inputPath in inputPaths:
+                if journal is not None:
+                    journal.record(inputPath, 'running')
+                job = augmentJob(inputPath=inputPath, outputPath=outputPath)
+                start = time.monotonic()
+                inboxes[0].put(job)
+                discoverMetrics['blocked'] += time.monotonic() - start
+                discoverMetrics['items'] += 1
+        except BaseException as e:
+            discoverErrors.append(e)
+        finally:
+            # each stage drains its queue before the next one is told to stop
+            for stage in stages:
+                stage.stop()
+            done.put(None)
+
+    feeder = threading.Thread(target=discover, name='discover', daemon=True)
+    feeder.start()
+
+    counts = defaultdict(int)
+    fileCount = 0
+    for job in iter(done.get, None):
+        result = job.finish()
+        record_result(result=result)
+        fileCount += 1
+        counts[result['status']] += 1
+        report_result(result=result, progress='[{:d}]'.format(fileCount))
+    feeder.join()
+    if discoverErrors:
+        raise discoverErrors[0]
+
+    print('augmented {:d} files: {}'.format(
+        fileCount, ', '.join('{}={}'.format(k, v) for k, v in sorted(counts.items()))))
+    print('pipeline stage discover: items={:d}, blocked={:.2f}s'.format(
+        discoverMetrics['items'], discoverMetrics['blocked']))
+    for stage in stages:
+        print('pipeline stage {}: {}'.format(
+            stage.name, ', '.join('{}={}'.format(k, v) for k, v in stage.metrics().items())))
+    return counts
 
 
 def check_for_cs_predictions(uniprot_id, af_id):
+    if afIndex is not None:
+        af_entry_id = afIndex.get(genome_id=uniprot_id, protein_id=af_id)
+        if af_entry_id is None:
+            return False
+        return af_entry_id
+
     try:
         td = timedomain(cfgFile=cfgFile)
         af_entry_id = td.query(
@@ -562,33 +2374,106 @@ def check_for_cs_predictions(uniprot_id, af_id):
         return False
 
 
-def searchPathExt(inputPath, extension='.cif'):
-    extFileList = []
-    for root, dirs, files in os.walk(inputPath):
-        for file in files:
-            if file.endswith(extension):
-                extFileList.append(os.path.join(root, file))
-    return extFileList
+# layout of the --dirIndex listings, older listings are ignored and rewritten
+DIR_INDEX_FORMAT = 2
+
+
+def searchPathExt(inputPath, extension=CIF_EXTENSIONS, indexCache=None):
+    """
+    Lazily yield the files under inputPath ending in extension, top-down like os.walk, so augmentation
+    can start on the first directory while the rest of the tree is still being listed
+    :param inputPath: directory to search
+    :param extension: file name ending, or tuple of endings, to match
+    :param indexCache: optional directory of per-directory listings; a directory whose mtime matches its
+                       stored listing is not listed again
+    :return: generator of paths
+    """
+    stack = [inputPath]
+    while stack:
+        dirname = stack.pop()
+        listing = scan_directory(dirname=dirname, extension=extension, indexCache=indexCache)
+        if listing is None:
+            continue
+        for name in listing['files']:
+            yield os.path.join(dirname, name)
+        stack.extend(os.path.join(dirname, d) for d in reversed(listing['dirs']))
+
+
+def scan_directory(dirname, extension, indexCache=None):
+    """
+    List one directory: the names of its subdirectories and of its files ending in extension. With an index
+    cache, the stored listing is reused while the directory mtime is unchanged. A listing that cannot be written
+    to the cache is still returned
+    :return: dictionary with dirs and files, or None if the directory cannot be read
+    """
+    try:
+        mtime_ns = os.stat(dirname).st_mtime_ns
+    except OSError:
+        return None
+
+    indexFile = None
+    if indexCache:
+        key = hashlib.sha1('{}\0{}'.format(os.path.abspath(dirname), extension).encode()).hexdigest()
+        indexFile = os.path.join(indexCache, key + '.json')
+        try:
+            with open(indexFile) as jsp:
+                listing = json.load(jsp)
+            if listing['format'] == DIR_INDEX_FORMAT and listing['mtime_ns'] == mtime_ns:
+                return listing
+        except (OSError, ValueError, KeyError):
+            pass
+
+    listing = OrderedDict([('format', DIR_INDEX_FORMAT), ('dir', os.path.abspath(dirname)), ('mtime_ns', mtime_ns),
+                           ('dirs', []), ('files', [])])
+    try:
+        with os.scandir(dirname) as it:
+            for entry in it:
+                # like os.walk, symlinked directories are not descended into (a link cycle would never end)
+                if entry.is_dir(follow_symlinks=False):
+                    listing['dirs'].append(entry.name)
+                elif entry.name.endswith(extension) and not entry.is_dir():
+                    listing['files'].append(entry.name)
+    except OSError:
+        return None
+
+    if indexFile:
+        tmpFilename = '{}.{}.tmp'.format(indexFile, os.getpid())
+        try:
+            os.makedirs(indexCache, exist_ok=True)
+            with open(tmpFilename, 'w') as jsp:
+                json.dump(listing, jsp, separators=(',', ':'))
+            os.replace(tmpFilename, indexFile)
+        except OSError:
+            try:
+                os.remove(tmpFilename)
+            except OSError:
+                pass
+    return listing
 
 
 def reboxitoryPath_to_uniprotAF(reboxitoryPath):
     p = Path(reboxitoryPath)
-    af_id = p.stem
+    af_id = cif_model_name(reboxitoryPath)
     uniprot_id = p.parts[-2]
     return uniprot_id, af_id
 
 
-def print_orig_cif(orig_cifFile, augmented_cifFilename, af_id):
-    with open(orig_cifFile) as file:
+def print_orig_cif(orig_cifFile, doc, af_id):
+    doc.write(read_orig_cif_header(orig_cifFile=orig_cifFile, af_id=af_id))
+
+
+def read_orig_cif_header(orig_cifFile, af_id):
+    """
+    Return the text of the original file between the _entry.id line and the _atom_site loop
+    """
+    with open_cif(orig_cifFile) as file:
         lines = file.readlines()
 
     afEntry = ('-').join(af_id.split('-')[:-1])
     line_number_start = find_line_number(lines=lines, string_to_parse=f"_entry.id {afEntry}") + 1
     line_number_cutoff = find_line_number(lines=lines, string_to_parse='_atom_site.group_PDB') -1
 
-    # with open(augmented_cifFilename, mode='wt', encoding='utf-8') as myfile:
-    with open(augmented_cifFilename, mode='a', encoding='utf-8') as myfile:
-        myfile.write(''.join(lines[line_number_start:line_number_cutoff]))
+    return ''.join(lines[line_number_start:line_number_cutoff])
 
 
 def find_line_number(lines, string_to_parse):
@@ -609,37 +2494,89 @@ def count_residues(af_id):
 
 
 def queeryCS_to_dictionary(af_id):
-    csDict = defaultdict()
-
-    td = timedomain(cfgFile=cfgFile)
-    csp_id_dict = td.query(
-        basename='selectUniqueAF_cspID',
-        subs={
-            '%%%AFID%%%': af_id}).data
-
-    cspID_dict = filter_csps(uniqueList=csp_id_dict, filter=cspID_list)
+    try:
+        return csPrefetch.pop(af_id)
+    except KeyError:
+        return queeryCS_to_dictionaries(af_ids=[af_id])[af_id]
 
-    for id in cspID_dict:
-        cs_pred = td.query(
-            basename='compareCSP',
-            subs={
-                "%%%AFID%%%": af_id,
-                "%%%CSPID%%%": id['csp_id']}
-        ).data
-        csDict[id['csp_id']] = listDict_to_DictList(listDict=cs_pred)
-    return csDict
 
+def queeryCS_to_dictionaries(af_ids):
+    """
+    Fetch the standardized chemical shifts of every predictor in cspID_list for one or many proteins
+    in a single round trip, grouping the rows client-side by af_id and csp_id
+    :param af_ids: list of alpha.af_id ids
+    :return: dictionary of af_id -> chemicalShiftIndex
+    """
+    csIndexes = {af_id: chemicalShiftIndex() for af_id in af_ids}
+    if not af_ids:
+        return csIndexes
 
-def listDict_to_DictList(listDict):
-    dct = defaultdict(list)
-    for e in listDict:
-        for k in e.keys():
-            dct[k].append(e[k])
-    return dct
+    td = timedomain(cfgFile=cfgFile)
+    subs = {
+        "%%%AFIDS%%%": ', '.join(str(int(af_id)) for af_id in af_ids),
+        "%%%CSPIDS%%%": ', '.join(str(int(cspID)) for cspID in cspID_list)}
+    cs_pred = td.query(
+        basename=SHIFT_SOURCES[shift_source],
+        subs=subs
+    )
+
+    # rows are ordered by af_id, csp_id, res_sequence
+    grouped = OrderedDict()
+    for row in cs_pred:
+        grouped.setdefault((row['af_id'], row['csp_id']), []).append(row)
+
+    if shift_source == 'table':
+        # the table only returns proteins whose standardized rows are current, the others (loaded since the
+        # last ingestAlphaFoldCS.py --refreshStd) are standardized by the Q_compareCSP join instead
+        current = {af_id for af_id, cspID in grouped}
+        stale = [af_id for af_id in af_ids if af_id not in current]
+        if stale:
+            staleSubs = dict(subs)
+            staleSubs['%%%AFIDS%%%'] = ', '.join(str(int(af_id)) for af_id in stale)
+            for row in td.query(basename=SHIFT_SOURCES['query'], subs=staleSubs):
+                grouped.setdefault((row['af_id'], row['csp_id']), []).append(row)
+
+    if shift_source == 'client':
+        # raw predictions, standardized here against the cached atom_naming and the model's residue types
+        global atomNaming
+        if atomNaming is None:
+            atomNaming = atomNamingIndex.load(cfgFile=cfgFile)
+        residueTypes = defaultdict(lambda: defaultdict(list))
+        for row in td.query(basename='selectResidueTypes_batch', subs=subs).data:
+            residueTypes[row['af_id']][row['residue_sequence']].append(row['residue_type'])
+        for key, rows in grouped.items():
+            grouped[key] = standardize_predictions(cspID=key[1], rawRows=rows, residueTypes=residueTypes[key[0]],
+                                                   naming=atomNaming)
+
+    for (af_id, cspID), rows in grouped.items():
+        csIndexes[af_id].add(cspID=cspID, rows=rows)
+    return csIndexes
+
+
+def prefetch_cs_predictions(inputPaths):
+    """
+    Fetch the chemical shifts of a batch of AlphaFold files in one query, ahead of the atom_site writer
+    :param inputPaths: list of AlphaFold mmCIF paths
+    :return:
+    """
+    af_entry_ids = []
+    for inputPath in inputPaths:
+        uniprot_id, af_id = reboxitoryPath_to_uniprotAF(inputPath)
+        af_entry_id = check_for_cs_predictions(uniprot_id=uniprot_id, af_id=af_id)
+        if af_entry_id:
+            af_entry_ids.append(af_entry_id)
+    csPrefetch.update(queeryCS_to_dictionaries(af_ids=af_entry_ids))
 
 
-def filter_csps(uniqueList, filter):
-    return [csp_id for csp_id in uniqueList if csp_id['csp_id'] in filter]
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def query_afH_atoms(af_id, chain='A'):
@@ -651,33 +2588,13 @@ def query_afH_atoms(af_id, chain='A'):
             "%%%AFID%%%": af_id,
             "%%%CHAIN%%%": chain
         }
-    ).data
+    )
+    # rows are streamed when Q_select_pdbAtoms sets an itersize
     return afH_atoms
 
 
-def searchDictDictList(dct, resNum, atom, cspID):
-    atomIdx = None
-    # indices = dct[cspID]['res_sequence'].index(resNum)
-    indices = [i for i, x in enumerate(dct[cspID]['res_sequence']) if x == resNum]
-
-    for i in indices:
-        if dct[cspID]['atom'][i] == atom:
-            atomIdx = i
-    if atomIdx:
-        return dct[cspID]['chemical_shift'][atomIdx]
-    else:
-        return None
-
-
-def check_for_spaceDelimiter(filename, delimiter='#'):
-    with open(filename, 'rb') as f:
-        try:  # catch OSError in case of a one line file
-            f.seek(-2, os.SEEK_END)
-            while f.read(1) != b'\n':
-                f.seek(-2, os.SEEK_CUR)
-        except OSError:
-            f.seek(0)
-        lastLine = f.readline().decode()
+def check_for_spaceDelimiter(doc, delimiter='#'):
+    lastLine = doc.last_line()
 
     if lastLine.rstrip() == delimiter:
         return True
@@ -685,34 +2602,18 @@ def check_for_spaceDelimiter(filename, delimiter='#'):
         return False
 
 
-# def print_loop_noVals(filename, loopList):
-#     if check_for_spaceDelimiter(filename=filename)
+# def print_loop_noVals(doc, loopList):
+#     if check_for_spaceDelimiter(doc=doc)
 #
 
 
-def print_ascension_ids(augmented_cifFilename, uniprot_id, af_id):
-    with open(mapping_file) as file:
-        lines = file.readlines()
-
-    bmrb_id = []
-    for line in lines:
-        af_file_path = line.rstrip().split(' ')[0]
-        if af_file_path.split('/')[-1].strip('.pdb') == af_id:
-            spline = line.rstrip().strip(af_file_path).split(',')
+def print_ascension_ids(doc, uniprot_id, af_id):
+    global mapIndex
+    if mapIndex is None:
+        mapIndex = mappingIndex(mappingFile=mapping_file)
 
-            for entry in spline:
-                tmp_id = str()
-                for e in list(filter(None, entry)):
-                    try:
-                        int(e)
-                    except ValueError:
-                        continue
-                    tmp_id += e
-                bmrb_id.append(tmp_id)
-    bmrbID_list = list(set(bmrb_id))
-    pdbID_list = []
-    for bmrbID in bmrbID_list:
-        pdbID_list.append(''.join(bmrb2pdb_ID(bmrbID)))
+    bmrbID_list = mapIndex.bmrb_ids(af_id)
+    pdbID_list = [mapIndex.pdb_id(bmrbID) for bmrbID in bmrbID_list]
 
     # with open(augmented_cifFilename, 'a') as file:
     #     print(f"_ascension_ids.uniprot {uniprot_id}", file)
@@ -730,21 +2631,19 @@ def print_ascension_ids(augmented_cifFilename, uniprot_id, af_id):
     fstring.append(f"_ascension_ids.uniprot {uniprot_id}\n")
     fstring.append(f"_ascension_ids.bmrb    {' '.join(bmrbID_list)}\n")
     fstring.append(f"_ascension_ids.pdb     {' '.join(pdbID_list)}\n")
-    with open(augmented_cifFilename, mode='a', encoding='utf-8') as myfile:
-        myfile.write(''.join(fstring))
+    doc.write(''.join(fstring))
 
     return None
 
 
-def print_loop_singleVal(filename, orderedDict):
+def print_loop_singleVal(doc, orderedDict):
     maxChar = len(max(list(orderedDict.keys()), key=len))
-    with open(filename, 'a') as file:
-        if not check_for_spaceDelimiter(filename=filename):
-            print("#", file=file)
-        print("loop_", file=file)
-        for k, v in orderedDict.items():
-            print(f"{k: <{maxChar + 3}} {v}", file=file)
-        print("#", file=file)
+    if not check_for_spaceDelimiter(doc=doc):
+        print("#", file=doc)
+    print("loop_", file=doc)
+    for k, v in orderedDict.items():
+        print(f"{k: <{maxChar + 3}} {v}", file=doc)
+    print("#", file=doc)
     return None
 
 
@@ -765,7 +2664,7 @@ def fstring_dictionary(val_dic, len_restrict_dict):
     return return_string
 
 
-def print_loop_multiVal(filename, orderedDict):
+def print_loop_multiVal(doc, orderedDict):
     dict_maxLen = dict()
 
     for cspID in orderedDict:
@@ -775,33 +2674,32 @@ def print_loop_multiVal(filename, orderedDict):
             except KeyError:
                 dict_maxLen[k] = str(v).__len__()
 
-    with open(filename, 'a') as file:
-        if not check_for_spaceDelimiter(filename=filename):
-            print("#", file=file)
-        print("loop_", file=file)
+    if not check_for_spaceDelimiter(doc=doc):
+        print("#", file=doc)
+    print("loop_", file=doc)
 
-        for k in orderedDict.keys():
-            # maxChar = len(max(list(orderedDict[k].keys()), key=len))
-            if k == first(orderedDict):
-                for subDict_key in orderedDict[k].keys():
-                    print(subDict_key, file=file)
+    for k in orderedDict.keys():
+        # maxChar = len(max(list(orderedDict[k].keys()), key=len))
+        if k == first(orderedDict):
+            for subDict_key in orderedDict[k].keys():
+                print(subDict_key, file=doc)
 
-            print(fstring_dictionary(val_dic=orderedDict[k], len_restrict_dict=dict_maxLen), file=file)
+        print(fstring_dictionary(val_dic=orderedDict[k], len_restrict_dict=dict_maxLen), file=doc)
 
 
 
-def print_protonation_loop(outputFile):
+def print_protonation_loop(doc):
     # TODO: future versions need to be dynamic to include multiple software methods/versions
     odict = OrderedDict()
     odict['_protonation_method.idx'] = 1
     odict['_protonation_method.name'] = 'REDUCE'
     # odict['_protonation_method.version'] = 'reduce.4.7.210416'
     odict['_protonation_method.version'] = '4.7.210416'
-    print_loop_singleVal(filename=outputFile, orderedDict=odict)
+    print_loop_singleVal(doc=doc, orderedDict=odict)
     return None
 
 
-def print_csp_loop(outputFile, cspList):
+def print_csp_loop(doc, cspList):
     # TODO: future versions need to be dynamic to include multiple software methods/versions
     odict = defaultdict(lambda: OrderedDict())
     orederedDict = defaultdict(lambda: OrderedDict())
@@ -847,7 +2745,7 @@ def print_csp_loop(outputFile, cspList):
         if cspID in list(odict.keys()):
             orederedDict[cspID] = odict[cspID]
 
-    print_loop_multiVal(filename=outputFile, orderedDict=orederedDict)
+    print_loop_multiVal(doc=doc, orderedDict=orederedDict)
 
 
 def checkCategoryInLoop(loop, categoryName, delimiter='.'):
@@ -856,7 +2754,7 @@ def checkCategoryInLoop(loop, categoryName, delimiter='.'):
         return True
 
 
-def print_atom_site_loop(outputFile, cspList, cifDict):
+def print_atom_site_loop(doc, cspList, cifDict):
     loopNum = categoryName_loopNumber(loopsDict=cifDict.loops, categoryName='_atom_site')
     # TODO: dynamically determine the number of sets of protonated coordinates and chemical shift columns to include
     loop = cifDict.loops[loopNum]
@@ -870,136 +2768,352 @@ def print_atom_site_loop(outputFile, cspList, cifDict):
         loop.insert(insert_index, f"_atom_site.chemical_shift_predictor_{cspID}")
         insert_index += 1
 
-    with open(outputFile, 'a') as file:
-        if check_for_spaceDelimiter(filename=outputFile):
-            print("loop_", file=file)
-        elif not check_for_spaceDelimiter(filename=outputFile, delimiter="#") \
-                and not check_for_spaceDelimiter(filename=outputFile, delimiter="loop_"):
-            print("#", file=file)
-            print("loop_", file=file)
+    if check_for_spaceDelimiter(doc=doc):
+        print("loop_", file=doc)
+    elif not check_for_spaceDelimiter(doc=doc, delimiter="#") \
+            and not check_for_spaceDelimiter(doc=doc, delimiter="loop_"):
+        print("#", file=doc)
+        print("loop_", file=doc)
 
-        for loop_entry in loop:
-            print(loop_entry, file=file)
+    for loop_entry in loop:
+        print(loop_entry, file=doc)
     return None
 
 
-def print_aug_atom_site(csDict, augmented_csFilename, af_id, af_entry_name, af_file):
-    cf = cif.ReadCif(af_file)
-    cifDict = cf.dictionary['-'.join(af_entry_name.split('-')[:3]).lower()]
-    afH_atoms = query_afH_atoms(af_id=af_id)
-    number_residues = count_residues(af_id)
-    atomCount = len(cifDict.block['_atom_site.id'][0])
+class cifParseError(ValueError):
+    """
+    Raised by read_atom_site for mmCIF syntax it does not handle, callers fall back to PyCifRW
+    """
+    pass
+
 
-    print_protonation_loop(outputFile=augmented_csFilename)
-    print_csp_loop(outputFile=augmented_csFilename, cspList=list(csDict.keys()))
-    print_atom_site_loop(outputFile=augmented_csFilename, cspList=list(csDict.keys()), cifDict=cifDict)
-
-    with open(augmented_csFilename, "a") as cifFilename:
-        baseOffset_xref_db_num = int(cifDict.block['_atom_site.pdbx_sifts_xref_db_num'][0][0])
-        for atom in afH_atoms:
-            xCoord = [float(i) for i in cifDict.block['_atom_site.cartn_x'][0]]
-            yCoord = [float(i) for i in cifDict.block['_atom_site.cartn_y'][0]]
-            zCoord = [float(i) for i in cifDict.block['_atom_site.cartn_z'][0]]
-            xCoordLen = len(str(min(xCoord)))
-            yCoordLen = len(str(min(yCoord)))
-            zCoordLen = len(str(min(zCoord)))
-            coordStrLen = max([xCoordLen, yCoordLen, zCoordLen])
-
-            bFactorList = [float(i) for i in cifDict.block['_atom_site.b_iso_or_equiv'][0]]
-            bFacStrLen = len(str(max(bFactorList)))
-            xref_db_name_len = len(af_entry_name.split('-')[1])
-            xref_db_num_len = len(str(max([int(x) for x in cifDict.block['_atom_site.pdbx_sifts_xref_db_num'][0]])))
-
-            indices = [i for i, x in enumerate(cifDict.block['_atom_site.pdbx_sifts_xref_db_num'][0])
-                       if str(int(x) - (baseOffset_xref_db_num - 1)) == str(atom['residue_sequence'])]
-            atom_list = []
-
-            for i in indices:
-                atom_list.append(cifDict.block['_atom_site.auth_atom_id'][0][i])
-
-            # csValList = defaultdict(int)
-            csValList = []
-            for cspID in cspID_list:
-                # To handle chemical shift predictors that could not predict the chemical shifts of a particular protein
-                if cspID not in list(csDict.keys()):
-                    csValList.append(".")
+class atomSiteBlock:
+    """
+    The _atom_site loop of an mmCIF data block, laid out like the PyCifRW block it stands in for:
+    block[item][0] is the list of raw tokens of an item and loops maps a loop number to its item names
+    (item names are lowercased, as PyCifRW does)
+    """
+
+    def __init__(self, name, header, items, columns):
+        """
+        :param name: data block name (lowercased)
+        :param header: dictionary of the single value items read before the _atom_site loop (e.g. _entry.id)
+        :param items: _atom_site item names in loop order
+        :param columns: list of raw token lists, one per item
+        """
+        self.name = name
+        self.header = header
+        self.loops = {1: list(items)}
+        self.block = {item: (column,) for item, column in zip(items, columns)}
+        self.typed = dict()
+
+    def typed_column(self, item, typecode='d'):
+        """
+        Return a numeric copy of a column, converted once and cached
+        :param item: _atom_site item name
+        :param typecode: array typecode ('d' for float, 'l' for int)
+        :return: array.array
+        """
+        key = (item, typecode)
+        if key not in self.typed:
+            convert = float if typecode in 'fd' else int
+            self.typed[key] = array(typecode, map(convert, self.block[item][0]))
+        return self.typed[key]
+
+
+def tokenize_cif_line(line):
+    """
+    Split a line of an mmCIF loop into tokens, removing the quotes of quoted values
+    :param line: line of text
+    :return: list of tokens
+    """
+    if '\'' not in line and '"' not in line:
+        return line.split()
+
+    tokens = []
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c in ' \t\n\r':
+            i += 1
+        elif c in '\'"':
+            # a quoted value only ends at a matching quote followed by whitespace
+            j = i + 1
+            while True:
+                j = line.find(c, j)
+                if j == -1:
+                    raise cifParseError('unterminated quoted value: {:s}'.format(line.rstrip()))
+                if j + 1 == n or line[j + 1] in ' \t\n\r':
+                    break
+                j += 1
+            tokens.append(line[i + 1:j])
+            i = j + 1
+        else:
+            j = i
+            while j < n and line[j] not in ' \t\n\r':
+                j += 1
+            tokens.append(line[i:j])
+            i = j
+    return tokens
+
+
+def read_atom_site(af_file):
+    """
+    Read only the _atom_site loop (and the data block name and header items before it) of an mmCIF file.
+    Stops reading at the end of the loop.
+    :param af_file: path to an AlphaFold mmCIF file
+    :return: atomSiteBlock
+    """
+    name = None
+    header = dict()
+    items = []
+    tokens = []
+
+    with open_cif(af_file) as file:
+        lines = iter(file)
+        inText = False
+        for line in lines:
+            if line.startswith(';'):
+                # multi-line text field of a header item, its lines are never item names or loops
+                inText = not inText
+            elif inText:
+                continue
+            elif line.startswith('data_'):
+                name = line[5:].strip().lower()
+            elif line.startswith('_') and not line.startswith('_atom_site.'):
+                try:
+                    tok = tokenize_cif_line(line)
+                except cifParseError:
                     continue
+                if len(tok) == 2:
+                    header[tok[0].lower()] = tok[1]
+            elif line.startswith('loop_'):
+                line = next(lines, '')
+                if not line.startswith('_atom_site.'):
+                    continue
+                while line.startswith('_atom_site.'):
+                    items.append(line.strip().lower())
+                    line = next(lines, '')
+                while line and not line.startswith(('#', 'loop_', '_', 'data_')):
+                    if line.startswith(';'):
+                        raise cifParseError('text field in _atom_site loop of {:s}'.format(af_file))
+                    tokens.extend(tokenize_cif_line(line))
+                    line = next(lines, '')
+                break
+
+    if not items:
+        raise cifParseError('no _atom_site loop in {:s}'.format(af_file))
+    if not tokens or len(tokens) % len(items):
+        raise cifParseError('{:d} _atom_site values do not fill {:d} columns in {:s}'.format(
+            len(tokens), len(items), af_file))
+    columns = [tokens[i::len(items)] for i in range(len(items))]
+    return atomSiteBlock(name=name, header=header, items=items, columns=columns)
+
+
+def read_model_cif(af_file, af_entry_name):
+    """
+    Parse an AlphaFold model with read_atom_site, falling back to PyCifRW for files it cannot handle
+    :param af_file: path to an AlphaFold mmCIF file
+    :param af_entry_name: AlphaFold model name, e.g. AF-O94312-F1-model_v1
+    :return: atomSiteBlock or PyCifRW block
+    """
+    try:
+        return read_atom_site(af_file)
+    except cifParseError:
+        pass
+    blockName = '-'.join(af_entry_name.split('-')[:3]).lower()
+    if not af_file.endswith('.gz'):
+        return cif.ReadCif(af_file).dictionary[blockName]
+    # PyCifRW only reads plain files
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.cif') as tmp:
+        with open_cif(af_file) as file:
+            shutil.copyfileobj(file, tmp)
+        tmp.flush()
+        return cif.ReadCif(tmp.name).dictionary[blockName]
+
+
+def float_column(cifDict, col, item):
+    if isinstance(cifDict, atomSiteBlock):
+        return cifDict.typed_column(item)
+    return [float(i) for i in col[item]]
+
+
+ATOM_SITE_COLUMNS = ['_atom_site.group_pdb', '_atom_site.id', '_atom_site.type_symbol', '_atom_site.label_atom_id',
+                     '_atom_site.label_alt_id', '_atom_site.label_comp_id', '_atom_site.label_asym_id',
+                     '_atom_site.label_entity_id', '_atom_site.label_seq_id', '_atom_site.pdbx_pdb_ins_code',
+                     '_atom_site.cartn_x', '_atom_site.cartn_y', '_atom_site.cartn_z', '_atom_site.occupancy',
+                     '_atom_site.b_iso_or_equiv', '_atom_site.pdbx_formal_charge', '_atom_site.auth_seq_id',
+                     '_atom_site.auth_comp_id', '_atom_site.auth_asym_id', '_atom_site.auth_atom_id',
+                     '_atom_site.pdbx_pdb_model_num', '_atom_site.pdbx_sifts_xref_db_acc',
+                     '_atom_site.pdbx_sifts_xref_db_name', '_atom_site.pdbx_sifts_xref_db_num',
+                     '_atom_site.pdbx_sifts_xref_db_res']
+
+
+def atom_site_columns(cifDict):
+    """
+    Pull the raw _atom_site columns out of the parsed block once, so rows can be indexed directly
+    :param cifDict: parsed mmCIF data block
+    :return: dictionary of column name -> list of raw string values
+    """
+    return {key: cifDict.block[key][0] for key in ATOM_SITE_COLUMNS}
 
-                csVal = searchDictDictList(dct=csDict, resNum=atom['residue_sequence'], atom=atom['protein_atom'],
-                                           cspID=cspID)
-                if csVal:
-                    # csValList[cspID] = csVal
-                    csValList.append(f"{csVal:.3f}")
-                else:
-                    csValList.append(".")
-            if atom['protein_atom'] in atom_list:
-                idx = indices[atom_list.index(atom['protein_atom'])]
-                print(f"{cifDict.block['_atom_site.group_pdb'][0][int(idx)]: <5}"
-                      f"{cifDict.block['_atom_site.id'][0][int(idx)]: <{len(str(atomCount)) + 1}}"
-                      f"{cifDict.block['_atom_site.type_symbol'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.label_atom_id'][0][int(idx)]: <4}"
-                      f"{cifDict.block['_atom_site.label_alt_id'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.label_comp_id'][0][int(idx)]: <4}"
-                      f"{cifDict.block['_atom_site.label_asym_id'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.label_entity_id'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.label_seq_id'][0][int(idx)]: <{len(str(number_residues)) + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_pdb_ins_code'][0][int(idx)]: <2}"
-                      f"{float(cifDict.block['_atom_site.cartn_x'][0][int(idx)]): <{coordStrLen + 1}.3f}"
-                      f"{float(cifDict.block['_atom_site.cartn_y'][0][int(idx)]): <{coordStrLen + 1}.3f}"
-                      f"{float(cifDict.block['_atom_site.cartn_z'][0][int(idx)]): <{coordStrLen + 1}.3f}"
-                      f"{float(atom['x_coord']): <{coordStrLen + 1}.3f}"
-                      f"{float(atom['y_coord']): <{coordStrLen + 1}.3f}"
-                      f"{float(atom['z_coord']): <{coordStrLen + 1}.3f}"
-                      f"{' '.join([f'{i:<7}' for i in csValList])} "
-                      # f"{' '.join([f'{i:<7.3f}' for i in csValList])}"
-                      f"{cifDict.block['_atom_site.occupancy'][0][int(idx)]: <4}"
-                      f"{cifDict.block['_atom_site.b_iso_or_equiv'][0][int(idx)]: <{bFacStrLen + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_formal_charge'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.auth_seq_id'][0][int(idx)]: <{len(str(number_residues)) + 1}}"
-                      f"{cifDict.block['_atom_site.auth_comp_id'][0][int(idx)]: <4}"
-                      f"{cifDict.block['_atom_site.auth_asym_id'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.auth_atom_id'][0][int(idx)]: <4}"
-                      f"{cifDict.block['_atom_site.pdbx_pdb_model_num'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_acc'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_name'][0][int(idx)]: <{xref_db_name_len + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_num'][0][int(idx)]: <{xref_db_num_len + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_res'][0][int(idx)]: <1}", file=cifFilename)
+
+def residue_atom_index(xref_db_num):
+    """
+    Group the _atom_site rows by residue number (pdbx_sifts_xref_db_num renumbered to start at 1)
+    :param xref_db_num: _atom_site.pdbx_sifts_xref_db_num column
+    :return: dictionary of residue number (str) -> list of row indices in file order
+    """
+    baseOffset_xref_db_num = int(xref_db_num[0])
+    resIndex = defaultdict(list)
+    for i, x in enumerate(xref_db_num):
+        resIndex[str(int(x) - (baseOffset_xref_db_num - 1))].append(i)
+    return resIndex
+
+
+def print_aug_atom_site(csDict, doc, af_id, af_entry_name, af_file, sidecar=None, cifDict=None, afH_atoms=None,
+                        number_residues=None):
+    # the pipeline parses and queries ahead, anything not passed in is read here
+    if cifDict is None:
+        cifDict = read_model_cif(af_file=af_file, af_entry_name=af_entry_name)
+    if afH_atoms is None:
+        afH_atoms = query_afH_atoms(af_id=af_id)
+    if number_residues is None:
+        number_residues = count_residues(af_id)
+    atomCount = len(cifDict.block['_atom_site.id'][0])
+
+    print_protonation_loop(doc=doc)
+    print_csp_loop(doc=doc, cspList=list(csDict.keys()))
+    print_atom_site_loop(doc=doc, cspList=list(csDict.keys()), cifDict=cifDict)
+
+    # everything below only depends on the model file, so gather the columns and field widths once
+    col = atom_site_columns(cifDict)
+    resIndex = residue_atom_index(xref_db_num=col['_atom_site.pdbx_sifts_xref_db_num'])
+    # first row of each atom name within a residue, matching list.index() on the residue's atoms
+    resAtomIndex = dict()
+    for resNum, indices in resIndex.items():
+        atomIdx = dict()
+        for i in indices:
+            atomIdx.setdefault(col['_atom_site.auth_atom_id'][i], i)
+        resAtomIndex[resNum] = atomIdx
+
+    xCoordLen = len(str(min(float_column(cifDict, col, '_atom_site.cartn_x'))))
+    yCoordLen = len(str(min(float_column(cifDict, col, '_atom_site.cartn_y'))))
+    zCoordLen = len(str(min(float_column(cifDict, col, '_atom_site.cartn_z'))))
+    coordStrLen = max([xCoordLen, yCoordLen, zCoordLen])
+
+    bFacStrLen = len(str(max(float_column(cifDict, col, '_atom_site.b_iso_or_equiv'))))
+    xref_db_name_len = len(af_entry_name.split('-')[1])
+    xref_db_num_len = len(str(max([int(x) for x in col['_atom_site.pdbx_sifts_xref_db_num']])))
+    atomIdLen = len(str(atomCount)) + 1
+    resNumLen = len(str(number_residues)) + 1
+
+    rows = []
+    for atom in afH_atoms:
+        indices = resIndex.get(str(atom['residue_sequence']), [])
+
+        # csValList = defaultdict(int)
+        csValList = []
+        csVals = []
+        for cspID in cspID_list:
+            # To handle chemical shift predictors that could not predict the chemical shifts of a particular protein
+            if cspID not in csDict:
+                csValList.append(".")
+                csVals.append(float('nan'))
+                continue
+
+            csVal = csDict.get(cspID=cspID, resNum=atom['residue_sequence'], atom=atom['protein_atom'])
+            if csVal is not None:
+                # csValList[cspID] = csVal
+                csValList.append(f"{csVal:.3f}")
+                csVals.append(float(csVal))
             else:
-                print(f"{cifDict.block['_atom_site.group_pdb'][0][int(indices[0])]: <5}"
-                      f"{atomCount + 1: <{len(str(atomCount)) + 1}}"
-                      f"{atom['element']: <2}"
-                      f"{atom['protein_atom']: <4}"
-                      f"{cifDict.block['_atom_site.label_alt_id'][0][int(indices[0])]: <2}"
-                      f"{atom['residue_type']: <4}"
-                      f"{cifDict.block['_atom_site.label_asym_id'][0][int(indices[0])]: <2}"
-                      f"{cifDict.block['_atom_site.label_entity_id'][0][int(indices[0])]: <2}"
-                      f"{atom['residue_sequence']: <{len(str(number_residues)) + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_pdb_ins_code'][0][int(indices[0])]: <2}"
-                      f"{'?': <{coordStrLen + 1}}"
-                      f"{'?': <{coordStrLen + 1}}"
-                      f"{'?': <{coordStrLen + 1}}"
-                      f"{float(atom['x_coord']): <{coordStrLen + 1}.3f}"
-                      f"{float(atom['y_coord']): <{coordStrLen + 1}.3f}"
-                      f"{float(atom['z_coord']): <{coordStrLen + 1}.3f}"
-                      f"{' '.join([f'{i:<7}' for i in csValList])} "
-                      f"{cifDict.block['_atom_site.occupancy'][0][int(indices[0])]: <4}"
-                      f"{cifDict.block['_atom_site.b_iso_or_equiv'][0][int(indices[0])]: <{bFacStrLen + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_formal_charge'][0][int(indices[0])]: <2}"
-                      f"{'?': <{len(str(number_residues)) + 1}}"
-                      f"{'?': <4}"
-                      f"{'?': <2}"
-                      f"{'?': <4}"
-                      f"{cifDict.block['_atom_site.pdbx_pdb_model_num'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_acc'][0][int(idx)]: <2}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_name'][0][int(idx)]: <{xref_db_name_len + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_num'][0][int(idx)]: <{xref_db_num_len + 1}}"
-                      f"{cifDict.block['_atom_site.pdbx_sifts_xref_db_res'][0][int(idx)]: <1}", file=cifFilename)
-                atomCount += 1
-
-
-def print_software(csDict, augmented_csFilename):
-    with open(augmented_csFilename) as file:
-        lines = file.readlines()
+                csValList.append(".")
+                csVals.append(float('nan'))
+        if atom['protein_atom'] in resAtomIndex.get(str(atom['residue_sequence']), {}):
+            idx = resAtomIndex[str(atom['residue_sequence'])][atom['protein_atom']]
+            if sidecar is not None:
+                sidecar.add(atomId=col['_atom_site.id'][idx], atomName=col['_atom_site.label_atom_id'][idx],
+                            resName=col['_atom_site.label_comp_id'][idx], element=col['_atom_site.type_symbol'][idx],
+                            resNum=atom['residue_sequence'],
+                            coords=(float(col['_atom_site.cartn_x'][idx]), float(col['_atom_site.cartn_y'][idx]),
+                                    float(col['_atom_site.cartn_z'][idx])),
+                            protonated=(float(atom['x_coord']), float(atom['y_coord']), float(atom['z_coord'])),
+                            bFactor=float(col['_atom_site.b_iso_or_equiv'][idx]), shifts=csVals)
+            rows.append(f"{col['_atom_site.group_pdb'][idx]: <5}"
+                        f"{col['_atom_site.id'][idx]: <{atomIdLen}}"
+                        f"{col['_atom_site.type_symbol'][idx]: <2}"
+                        f"{col['_atom_site.label_atom_id'][idx]: <4}"
+                        f"{col['_atom_site.label_alt_id'][idx]: <2}"
+                        f"{col['_atom_site.label_comp_id'][idx]: <4}"
+                        f"{col['_atom_site.label_asym_id'][idx]: <2}"
+                        f"{col['_atom_site.label_entity_id'][idx]: <2}"
+                        f"{col['_atom_site.label_seq_id'][idx]: <{resNumLen}}"
+                        f"{col['_atom_site.pdbx_pdb_ins_code'][idx]: <2}"
+                        f"{float(col['_atom_site.cartn_x'][idx]): <{coordStrLen + 1}.3f}"
+                        f"{float(col['_atom_site.cartn_y'][idx]): <{coordStrLen + 1}.3f}"
+                        f"{float(col['_atom_site.cartn_z'][idx]): <{coordStrLen + 1}.3f}"
+                        f"{float(atom['x_coord']): <{coordStrLen + 1}.3f}"
+                        f"{float(atom['y_coord']): <{coordStrLen + 1}.3f}"
+                        f"{float(atom['z_coord']): <{coordStrLen + 1}.3f}"
+                        f"{' '.join([f'{i:<7}' for i in csValList])} "
+                        f"{col['_atom_site.occupancy'][idx]: <4}"
+                        f"{col['_atom_site.b_iso_or_equiv'][idx]: <{bFacStrLen + 1}}"
+                        f"{col['_atom_site.pdbx_formal_charge'][idx]: <2}"
+                        f"{col['_atom_site.auth_seq_id'][idx]: <{resNumLen}}"
+                        f"{col['_atom_site.auth_comp_id'][idx]: <4}"
+                        f"{col['_atom_site.auth_asym_id'][idx]: <2}"
+                        f"{col['_atom_site.auth_atom_id'][idx]: <4}"
+                        f"{col['_atom_site.pdbx_pdb_model_num'][idx]: <2}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_acc'][idx]: <2}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_name'][idx]: <{xref_db_name_len + 1}}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_num'][idx]: <{xref_db_num_len + 1}}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_res'][idx]: <1}\n")
+        else:
+            if sidecar is not None:
+                sidecar.add(atomId=atomCount + 1, atomName=atom['protein_atom'], resName=atom['residue_type'],
+                            element=atom['element'], resNum=atom['residue_sequence'],
+                            coords=(float('nan'),) * 3,
+                            protonated=(float(atom['x_coord']), float(atom['y_coord']), float(atom['z_coord'])),
+                            bFactor=float(col['_atom_site.b_iso_or_equiv'][indices[0]]), shifts=csVals)
+            # atoms added by REDUCE reuse the model and sifts columns of the last heavy atom written (idx)
+            rows.append(f"{col['_atom_site.group_pdb'][indices[0]]: <5}"
+                        f"{atomCount + 1: <{atomIdLen}}"
+                        f"{atom['element']: <2}"
+                        f"{atom['protein_atom']: <4}"
+                        f"{col['_atom_site.label_alt_id'][indices[0]]: <2}"
+                        f"{atom['residue_type']: <4}"
+                        f"{col['_atom_site.label_asym_id'][indices[0]]: <2}"
+                        f"{col['_atom_site.label_entity_id'][indices[0]]: <2}"
+                        f"{atom['residue_sequence']: <{resNumLen}}"
+                        f"{col['_atom_site.pdbx_pdb_ins_code'][indices[0]]: <2}"
+                        f"{'?': <{coordStrLen + 1}}"
+                        f"{'?': <{coordStrLen + 1}}"
+                        f"{'?': <{coordStrLen + 1}}"
+                        f"{float(atom['x_coord']): <{coordStrLen + 1}.3f}"
+                        f"{float(atom['y_coord']): <{coordStrLen + 1}.3f}"
+                        f"{float(atom['z_coord']): <{coordStrLen + 1}.3f}"
+                        f"{' '.join([f'{i:<7}' for i in csValList])} "
+                        f"{col['_atom_site.occupancy'][indices[0]]: <4}"
+                        f"{col['_atom_site.b_iso_or_equiv'][indices[0]]: <{bFacStrLen + 1}}"
+                        f"{col['_atom_site.pdbx_formal_charge'][indices[0]]: <2}"
+                        f"{'?': <{resNumLen}}"
+                        f"{'?': <4}"
+                        f"{'?': <2}"
+                        f"{'?': <4}"
+                        f"{col['_atom_site.pdbx_pdb_model_num'][idx]: <2}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_acc'][idx]: <2}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_name'][idx]: <{xref_db_name_len + 1}}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_num'][idx]: <{xref_db_num_len + 1}}"
+                        f"{col['_atom_site.pdbx_sifts_xref_db_res'][idx]: <1}\n")
+            atomCount += 1
+
+    doc.write(''.join(rows))
+
+
+def print_software(csDict, doc):
+    lines = doc.readlines()
 
     line_number_start = find_line_number(lines=lines, string_to_parse='_software.classification')
     line_number_stop = find_line_number(lines=lines[line_number_start:], string_to_parse='#') + line_number_start
@@ -1051,7 +3165,7 @@ def print_software(csDict, augmented_csFilename):
                     myDict[key].append(f"\"Chemical shift prediction\"")
                 else:
                     myDict[key].append(odict[cspID][key])
-    os.remove(augmented_csFilename)
+    doc.clear()
 
     orderedDict = {idx: OrderedDict() for idx in range(0, myDict['_software.type'].__len__())}
     for dictIdx in list(orderedDict.keys()):
@@ -1060,41 +3174,37 @@ def print_software(csDict, augmented_csFilename):
         for key in keyList:
             orderedDict[idx][key] = myDict[key][idx]
 
-    # print to file original two ends of the file with updated sliced data
-    with open(augmented_csFilename, mode='a', encoding='utf-8') as myfile:
-        myfile.write(''.join(lines[:line_number_start-2]))
-    print_loop_multiVal(filename=augmented_csFilename, orderedDict=orderedDict)
-    with open(augmented_csFilename, mode='a', encoding='utf-8') as myfile:
-        myfile.write(''.join(lines[line_number_stop:]))
+    # rebuild the document from its original two ends with updated sliced data
+    doc.write(''.join(lines[:line_number_start-2]))
+    print_loop_multiVal(doc=doc, orderedDict=orderedDict)
+    doc.write(''.join(lines[line_number_stop:]))
 
 
-def print_authorList(augmented_csFilename):
-    with open(augmented_csFilename) as file:
-        lines = file.readlines()
+def print_authorList(doc):
+    lines = doc.readlines()
 
     line_number_start = find_line_number(lines=lines, string_to_parse='_audit_author.pdbx_ordinal')
     line_number_stop = find_line_number(lines=lines[line_number_start:], string_to_parse='#') + line_number_start
 
     lines_authorNames = lines[line_number_start+1:line_number_stop]
 
-    os.remove(augmented_csFilename)
-    with open(augmented_csFilename, mode='a', encoding='utf-8') as myfile:
-        myfile.write(''.join(lines[:line_number_start]))
-        print(f"_audit_author.ORCID", file=myfile)
-        print(f"_audit_author.address", file=myfile)
-        myfile.write(''.join(lines_authorNames))
-        print(
-            f"\"Craft, D. Levi\"             "
-            f"34"
-            f" 0000-0003-3077-3402 Department of Molecular Biology and Biophysics University "
-            f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=myfile)
-        print(
-            f"\"Schuyler, Adam D.\"          35 0000-0001-7583-899X Department of Molecular Biology and Biophysics University "
-            f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=myfile)
-        print(
-            f"\"Gryk, Michael R.\"           36 0000-0002-3483-8384 Department of Molecular Biology and Biophysics University "
-            f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=myfile)
-        myfile.write(''.join(lines[line_number_stop:]))
+    doc.clear()
+    doc.write(''.join(lines[:line_number_start]))
+    print(f"_audit_author.ORCID", file=doc)
+    print(f"_audit_author.address", file=doc)
+    doc.write(''.join(lines_authorNames))
+    print(
+        f"\"Craft, D. Levi\"             "
+        f"34"
+        f" 0000-0003-3077-3402 Department of Molecular Biology and Biophysics University "
+        f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=doc)
+    print(
+        f"\"Schuyler, Adam D.\"          35 0000-0001-7583-899X Department of Molecular Biology and Biophysics University "
+        f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=doc)
+    print(
+        f"\"Gryk, Michael R.\"           36 0000-0002-3483-8384 Department of Molecular Biology and Biophysics University "
+        f"of Connecticut Health Center 263 Farmington Ave, Farmington CT 06030\"", file=doc)
+    doc.write(''.join(lines[line_number_stop:]))
 
 
 def main():
@@ -1104,15 +3214,71 @@ def main():
                         required=True)
     parser.add_argument('--outputPath', help='destination of augmented mmCIF files', required=True)
     parser.add_argument('--mappingFile', help='flat file of AF to BMRB mappings', required=True)
+    parser.add_argument('--prefetch', help='number of proteins of a directory whose chemical shifts are fetched '
+                                           'in a single query (0 fetches one protein at a time)', type=int, default=0)
+    parser.add_argument('--refreshAfIndex', help='seconds between incremental reloads of the in-memory alpha.af_id '
+                                                 'index during long runs', type=float, default=None)
+    parser.add_argument('--fromMapping', help='augment only the models listed in the mapping file, resolved '
+                                              'under --afPath, instead of walking the whole tree',
+                        action='store_true')
+    parser.add_argument('--dirIndex', help='directory of cached directory listings, so later runs against the '
+                                           'same snapshot skip listing unchanged directories', default=None)
+    parser.add_argument('--journal', help='JSONL run journal of per-file state '
+                                          '(default: augment_journal.jsonl in --outputPath)', default=None)
+    parser.add_argument('--resume', help='only augment the files the journal does not have as done (files '
+                                         'that had no predictions are tried again)', action='store_true')
+    parser.add_argument('--compressOutput', help='write gzip compressed augmented files (.cif.gz)',
+                        action='store_true')
+    parser.add_argument('--sidecar', help='also write a columnar copy of each augmented _atom_site loop '
+                                          '(npz needs numpy, parquet needs pyarrow)',
+                        choices=atomSiteSidecar.FORMATS, default=None)
+    parser.add_argument('--shiftSource', help='query: standardize chemical shifts with the Q_compareCSP join; '
+                                              'table: read them from alpha.cs_prediction_std (kept current by '
+                                              'ingestAlphaFoldCS.py --refreshStd, proteins loaded since are '
+                                              'standardized by the join); client: standardize raw '
+                                              'predictions in Python against a cached alpha.atom_naming',
+                        choices=list(SHIFT_SOURCES), default=DEFAULT_SHIFT_SOURCE)
+    parser.add_argument('--metricsLog', help='JSONL log of the per-stage timings, atom and predictor counts and '
+                                             'output size of every file (default: augment_metrics.jsonl in '
+                                             '--outputPath)', default=None)
+    parser.add_argument('--prometheusFile', help='Prometheus textfile (for the node_exporter textfile collector) '
+                                                 'rewritten with the run metrics during the run', default=None)
+    parser.add_argument('--prometheusInterval', help='seconds between rewrites of --prometheusFile',
+                        type=float, default=30.0)
+    parser.add_argument('--profileDir', help='time every file and run slow outliers again under cProfile, keeping '
+                                             'their dumps (<model>.pstats) in this directory, ranked in '
+                                             'slow_files.txt',
+                        default=None)
+    parser.add_argument('--profileThreshold', help='seconds from which a file is a slow outlier', type=float,
+                        default=None)
+    parser.add_argument('--profilePercentile', help='a file slower than this percentile of the recent files of '
+                                                    'its process is a slow outlier', type=float, default=None)
+    parser.add_argument('--profileMemory', help='also trace allocations of re-run outliers and keep a tracemalloc '
+                                                'snapshot (<model>.tracemalloc) of slow outliers',
+                        action='store_true')
+    parser.add_argument('--workers', help='number of processes augmenting the files of a directory',
+                        type=int, default=1)
+    parser.add_argument('--pipeline', help='augment files in a staged thread pipeline, overlapping database '
+                                           'queries, parsing and writing of different files',
+                        action='store_true')
+    parser.add_argument('--stageWorkers', help='threads per pipeline stage as stage=n pairs, stages are ' +
+                                               ', '.join(AUGMENT_STAGES),
+                        default=','.join('{}={}'.format(k, v) for k, v in PIPELINE_WORKERS.items()))
+    parser.add_argument('--queueDepth', help='capacity of the queues between pipeline stages',
+                        type=int, default=PIPELINE_QUEUE_DEPTH)
+    parser.add_argument('--bmrbPdbTable', help='JSON sidecar of BMRB to PDB ids, built from the mapping file '
+                                               'on the first run and reused afterwards', default=None)
 
     args = parser.parse_args()
     global cfgFile
     cfgFile = args.cfg_file
 
-    global afList
+    global afIndex
     td = timedomain(cfgFile=cfgFile)
     afList = td.query(
         basename='selectAll_afID').data
+    afIndex = afIDIndex(refresh_interval=args.refreshAfIndex)
+    afIndex.load(rows=afList)
 
     global cspID_list
     cspID_list = [1, 2, 3, 4, 5, 6, 8]
@@ -1120,13 +3286,84 @@ def main():
     global mapping_file
     mapping_file = args.mappingFile
 
+    global mapIndex
+    mapIndex = mappingIndex(mappingFile=mapping_file, pdbTable=args.bmrbPdbTable)
+    if args.bmrbPdbTable and not os.path.isfile(args.bmrbPdbTable):
+        mapIndex.write_pdb_table(pdbTable=args.bmrbPdbTable)
+
+    global prefetch_size
+    prefetch_size = args.prefetch
+
+    global dir_index
+    dir_index = args.dirIndex
+
+    global compress_output
+    compress_output = args.compressOutput
+
+    global shift_source, atomNaming
+    shift_source = args.shiftSource
+    if shift_source == 'client':
+        atomNaming = atomNamingIndex.load(cfgFile=cfgFile)
+
+    global sidecar_format
+    if args.sidecar == 'npz' and np is None:
+        parser.error('--sidecar npz requires numpy')
+    if args.sidecar == 'parquet' and pq is None:
+        parser.error('--sidecar parquet requires pyarrow')
+    sidecar_format = args.sidecar
+
+    global profiler
+    if args.profileDir:
+        if args.profileThreshold is None and args.profilePercentile is None:
+            parser.error('--profileDir needs --profileThreshold or --profilePercentile')
+        if args.profilePercentile is not None and not 0 < args.profilePercentile < 100:
+            parser.error('--profilePercentile must be between 0 and 100')
+        if args.pipeline:
+            parser.error('--profileDir profiles one file at a time, it cannot be combined with --pipeline')
+        profiler = slowFileProfiler(directory=args.profileDir, threshold=args.profileThreshold,
+                                    percentile=args.profilePercentile, memory=args.profileMemory)
+
+    global pipeline_stages, pipeline_queue_depth
+    if args.pipeline:
+        if args.workers > 1:
+            parser.error('--pipeline runs in one process, it cannot be combined with --workers')
+        if args.prefetch:
+            parser.error('--pipeline fetches the chemical shifts of each file itself, drop --prefetch')
+        if args.queueDepth < 1:
+            parser.error('--queueDepth must be at least 1')
+        pipeline_stages = OrderedDict()
+        for pair in args.stageWorkers.split(','):
+            name, _, count = pair.partition('=')
+            if name.strip() not in AUGMENT_STAGES or not count.strip().isdigit() or int(count) < 1:
+                parser.error('invalid --stageWorkers entry {!r}'.format(pair))
+            pipeline_stages[name.strip()] = int(count)
+        pipeline_queue_depth = args.queueDepth
+
+    global journal, resume
+    journal = runJournal(filename=args.journal or os.path.join(args.outputPath, 'augment_journal.jsonl'))
+    resume = args.resume
+
+    global metrics
+    metrics = runMetrics(logFile=args.metricsLog or os.path.join(args.outputPath, 'augment_metrics.jsonl'),
+                         promFile=args.prometheusFile, promInterval=args.prometheusInterval)
+
     # For debugging purposes lets work with a single file
     # inputPath = '/reboxitory/2021/07/alphafold/UP000002485/AF-O94312-F1-model_v1.cif'
     # inputPath = '/reboxitory/2021/07/alphafold/UP000005640/AF-Q4G0P3-F15-model_v1.cif'
     # inputPath = '/reboxitory/2021/07/alphafold/UP000005640/AF-Q9BYW2-F1-model_v1.cif'
     # augment_mmCIF(inputPath=inputPath, outputPath=args.outputPath)
 
-    augment_mmCIF(inputPath=args.afPath, outputPath=args.outputPath)
+    if args.fromMapping:
+        augment_paths(inputPaths=mapped_cif_paths(afPath=args.afPath), outputPath=args.outputPath,
+                      workers=args.workers)
+    else:
+        augment_mmCIF(inputPath=args.afPath, outputPath=args.outputPath, workers=args.workers)
+    journal.close()
+    metrics.close()
+    metrics.report()
+    if profiler is not None:
+        profiler.report()
+    report_pool_metrics()
 
 
 if __name__ == '__main__':
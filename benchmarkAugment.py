@@ -0,0 +1,506 @@
+import argparse
+import configparser
+import functools
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import augmentAlphaFoldmmCIF as augment
+
+# heavy atoms (written to the model file) and hydrogens (added to protein_coord, as REDUCE does) of the
+# residues the synthetic models are built from
+RESIDUES = OrderedDict([
+    ('ALA', (['N', 'CA', 'C', 'O', 'CB'], ['H', 'HA', 'HB1', 'HB2', 'HB3'])),
+    ('GLY', (['N', 'CA', 'C', 'O'], ['H', 'HA2', 'HA3'])),
+    ('SER', (['N', 'CA', 'C', 'O', 'CB', 'OG'], ['H', 'HA', 'HB2', 'HB3', 'HG'])),
+    ('ASP', (['N', 'CA', 'C', 'O', 'CB', 'CG', 'OD1', 'OD2'], ['H', 'HA', 'HB2', 'HB3'])),
+    ('LYS', (['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD', 'CE', 'NZ'],
+             ['H', 'HA', 'HB2', 'HB3', 'HG2', 'HG3', 'HD2', 'HD3', 'HE2', 'HE3', 'HZ1', 'HZ2', 'HZ3'])),
+    ('LEU', (['N', 'CA', 'C', 'O', 'CB', 'CG', 'CD1', 'CD2'],
+             ['H', 'HA', 'HB2', 'HB3', 'HG', 'HD11', 'HD12', 'HD13', 'HD21', 'HD22', 'HD23'])),
+    ('VAL', (['N', 'CA', 'C', 'O', 'CB', 'CG1', 'CG2'],
+             ['H', 'HA', 'HB', 'HG11', 'HG12', 'HG13', 'HG21', 'HG22', 'HG23'])),
+])
+# chemical shift range (ppm) predicted for each element
+SHIFT_RANGES = {'H': (0.5, 10.0), 'C': (10.0, 180.0), 'N': (100.0, 135.0), 'O': None}
+# predictors that name the amide proton HN, standardized to H through alpha.atom_naming
+HN_PREDICTORS = (2, 5)
+
+PROTEOME = 'UPBENCH'
+DATASET_VERSION = 2
+
+ATOM_SITE_ITEMS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id',
+                   'label_asym_id', 'label_entity_id', 'label_seq_id', 'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y',
+                   'Cartn_z', 'occupancy', 'B_iso_or_equiv', 'pdbx_formal_charge', 'auth_seq_id', 'auth_comp_id',
+                   'auth_asym_id', 'auth_atom_id', 'pdbx_PDB_model_num', 'pdbx_sifts_xref_db_acc',
+                   'pdbx_sifts_xref_db_name', 'pdbx_sifts_xref_db_num', 'pdbx_sifts_xref_db_res']
+
+MODEL_HEADER = '''data_{entry}
+#
+_entry.id {entry}
+#
+loop_
+_audit_author.name
+_audit_author.pdbx_ordinal
+"Jumper, John" 1
+"Evans, Richard" 2
+"Pritzel, Alexander" 3
+#
+_audit_conform.dict_location https://raw.githubusercontent.com/ihmwg/ModelCIF/master/dist/mmcif_ma.dic
+_audit_conform.dict_name mmcif_ma.dic
+_audit_conform.dict_version 1.3.3
+#
+loop_
+_software.classification
+_software.date
+_software.description
+_software.name
+_software.pdbx_ordinal
+_software.type
+_software.version
+other ? "Structure prediction" AlphaFold 1 package v2.0
+#
+_struct_asym.entity_id 1
+_struct_asym.id A
+#
+loop_
+'''
+
+SCHEMA = '''
+create table alpha.af_id (id integer primary key, genome_id text, protein_id text);
+create table alpha.af_id_test (id integer primary key, genome_id text, protein_id text);
+create table alpha.cs_predictor (id integer primary key, csp_name text);
+create table alpha.experiment_conditions (id integer primary key, ph real, temp real);
+create table alpha.protein_coord (id integer primary key, af_id integer, atom_number integer, protein_atom text,
+    residue_type text, chain text, residue_sequence integer, x_coord real, y_coord real, z_coord real,
+    occupancy real, b_factor real, element text);
+create table alpha.cs_prediction (id integer primary key, af_id integer, csp_id integer, protein_atom text,
+    res_sequence integer, exp_id integer, chemical_shift real, res_name text);
+create table alpha.atom_naming (id integer primary key, csp_id integer, res_name text, protein_atom text,
+    atom_std text);
+create table alpha.cs_prediction_std (af_id integer, csp_id integer, res_sequence integer, residue_type text,
+    atom text, chemical_shift real);
+create table alpha.cs_prediction_std_state (af_id integer primary key, refreshed timestamp not null
+    default current_timestamp);
+'''
+
+INDEXES = '''
+create index alpha.protein_coord_af_idx on protein_coord (af_id, chain);
+create index alpha.cs_prediction_af_csp_idx on cs_prediction (af_id, csp_id);
+create index alpha.atom_naming_res_idx on atom_naming (res_name, protein_atom);
+create index alpha.cs_prediction_std_af_csp_idx on cs_prediction_std (af_id, csp_id, res_sequence);
+'''
+
+
+class sqliteSession:
+    """
+    Local stand-in for a postgreSQL session: the alpha schema lives in a SQLite file attached as alpha, so the
+    Q_ sections of the cfg file run unchanged. Statements are not prepared, SQLite caches their plans itself
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.execute('attach database ? as alpha', (filename,))
+        # connectionPool.release checks conn.conn.closed, like on a psycopg2 connection
+        self.conn = self
+        self.closed = 0
+        self.host = 'sqlite'
+        self.lastUsed = time.monotonic()
+
+    def query(self, q, params=None):
+        cur = self.db.execute(q, params or ())
+        rows = cur.fetchall()
+        self.db.commit()
+        self.lastUsed = time.monotonic()
+        return rows
+
+    def prepare(self, statement):
+        return False
+
+    def stream(self, q, itersize=2000):
+        cur = self.db.execute(q)
+        try:
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+        self.lastUsed = time.monotonic()
+
+    def ping(self):
+        return not self.closed
+
+    def close(self):
+        self.db.close()
+        self.closed = 1
+
+
+class sqlitePool(augment.connectionPool):
+    """
+    connectionPool handing out sqliteSessions on one SQLite file
+    """
+
+    def __init__(self, filename, size=4):
+        super().__init__(dbSection=None, size=size)
+        self.filename = filename
+
+    def connect(self):
+        self.stats['connects'] += 1
+        return sqliteSession(filename=self.filename)
+
+
+def query_databases(cfgFile):
+    """
+    Return the database sections named by the Q_ sections of a cfg file
+    """
+    cparser = configparser.ConfigParser(interpolation=None)
+    cparser.optionxform = str
+    cparser.read(cfgFile)
+    return sorted({cparser.get(sec, 'database') for sec in cparser.sections()
+                   if sec.startswith('Q_') and cparser.has_option(sec, 'database')})
+
+
+def write_benchmark_cfg(cfgFile, benchCfg, dbFile):
+    """
+    Copy the cfg file, pointing every database its queries use at the SQLite stand-in
+    """
+    cparser = configparser.ConfigParser(interpolation=None)
+    cparser.optionxform = str
+    cparser.read(cfgFile)
+    for name in query_databases(cfgFile):
+        if not cparser.has_section(name):
+            cparser.add_section(name)
+        cparser.set(name, 'host', 'sqlite')
+        cparser.set(name, 'host_local', 'sqlite')
+        cparser.set(name, 'username', 'benchmark')
+        cparser.set(name, 'dbname', dbFile)
+    with open(benchCfg, 'w') as file:
+        cparser.write(file)
+
+
+def install_sqlite_pools(cfgFile, dbFile, size=4):
+    """
+    Register a sqlitePool for every database of the cfg file, so get_pool never opens a server connection
+    """
+    for name in query_databases(cfgFile):
+        augment.connectionPools[name] = sqlitePool(filename=dbFile, size=size)
+
+
+augment_init_worker = augment.init_worker
+
+
+def init_sqlite_worker(settings, cfgFile, dbFile, size):
+    """
+    Process pool initializer of --workers runs: init_worker, then the stand-in pools in place of the server
+    connections the worker would open
+    """
+    augment_init_worker(settings)
+    install_sqlite_pools(cfgFile=cfgFile, dbFile=dbFile, size=size)
+
+
+def model_names(protein, fragments):
+    accession = 'B{:05d}'.format(protein)
+    return accession, ['AF-{}-F{:d}-model_v1'.format(accession, frag) for frag in range(1, fragments + 1)]
+
+
+def synthetic_model(rng, model, accession, residues):
+    """
+    Build one synthetic AlphaFold model
+    :return: mmCIF text of the heavy atoms and the protein_coord rows of every protonated atom
+    """
+    entry = '-'.join(model.split('-')[:-1])
+    lines = [MODEL_HEADER.format(entry=entry)]
+    lines.extend('_atom_site.{}\n'.format(item) for item in ATOM_SITE_ITEMS)
+    coords = []
+    atomId = 0
+    atomNumber = 0
+    sequence = [rng.choice(list(RESIDUES)) for _ in range(residues)]
+    for resNum, resName in enumerate(sequence, start=1):
+        heavy, hydrogens = RESIDUES[resName]
+        bFactor = rng.uniform(30.0, 98.0)
+        for atom in heavy:
+            atomId += 1
+            x, y, z = (rng.uniform(-60.0, 60.0) for _ in range(3))
+            lines.append('ATOM {:d} {} {} . {} A 1 {:d} ? {:.3f} {:.3f} {:.3f} 1.0 {:.2f} ? {:d} {} A {} 1 {} UNP '
+                         '{:d} {}\n'.format(atomId, atom[0], atom, resName, resNum, x, y, z, bFactor, resNum,
+                                           resName, atom, accession, resNum, resName[0]))
+        for atom in heavy + hydrogens:
+            atomNumber += 1
+            x, y, z = (rng.uniform(-60.0, 60.0) for _ in range(3))
+            coords.append((atomNumber, atom, resName, 'A', resNum, x, y, z, 1.0, 0.0, atom[0]))
+    lines.append('#\n')
+    return ''.join(lines), coords
+
+
+def synthetic_predictions(rng, afID, coords, predictors, coverage=0.85):
+    """
+    Predicted chemical shifts of the protonated atoms of a model, alpha.cs_prediction rows
+    """
+    for cspID in predictors:
+        for _, atom, resName, _, resNum, _, _, _, _, _, element in coords:
+            shiftRange = SHIFT_RANGES.get(element)
+            if shiftRange is None or rng.random() > coverage:
+                continue
+            name = 'HN' if atom == 'H' and cspID in HN_PREDICTORS else atom
+            yield afID, cspID, name, resNum, 1, round(rng.uniform(*shiftRange), 3), resName
+
+
+def generate_dataset(workDir, proteins, fragments, residues, predictors, seed):
+    """
+    Write the synthetic models under workDir/alphafold/<proteome> and load their coordinates, predictions and
+    atom names into the SQLite stand-in workDir/alpha.sqlite. A dataset generated with the same parameters and
+    at least as many proteins is reused
+    :return: manifest dictionary
+    """
+    manifest = OrderedDict([('version', DATASET_VERSION), ('proteins', proteins), ('fragments', fragments),
+                            ('residues', residues), ('predictors', predictors), ('seed', seed)])
+    manifestFile = os.path.join(workDir, 'dataset.json')
+    if os.path.isfile(manifestFile):
+        with open(manifestFile) as file:
+            existing = json.load(file)
+        if existing['proteins'] >= proteins and dict(existing, proteins=proteins) == manifest:
+            print('reusing the dataset in {}'.format(workDir))
+            return existing
+
+    modelPath = os.path.join(workDir, 'alphafold', PROTEOME)
+    dbFile = os.path.join(workDir, 'alpha.sqlite')
+    shutil.rmtree(os.path.join(workDir, 'alphafold'), ignore_errors=True)
+    os.makedirs(modelPath)
+    for filename in (dbFile, manifestFile):
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    start = time.monotonic()
+    rng = random.Random(seed)
+    db = sqlite3.connect(':memory:')
+    db.execute('attach database ? as alpha', (dbFile,))
+    db.execute('pragma alpha.journal_mode = off')
+    db.execute('pragma alpha.synchronous = off')
+    db.executescript(SCHEMA)
+    db.executemany('insert into alpha.cs_predictor (id, csp_name) values (?, ?)',
+                   [(cspID, 'predictor_{:d}'.format(cspID)) for cspID in predictors])
+    db.execute('insert into alpha.experiment_conditions (id, ph, temp) values (1, null, null)')
+    db.executemany('insert into alpha.atom_naming (csp_id, res_name, protein_atom, atom_std) values (?, ?, ?, ?)',
+                   [(HN_PREDICTORS[0], resName, 'HN', 'H') for resName in RESIDUES])
+
+    afID = 0
+    for protein in range(1, proteins + 1):
+        accession, models = model_names(protein, fragments)
+        for model in models:
+            afID += 1
+            text, coords = synthetic_model(rng=rng, model=model, accession=accession, residues=residues)
+            with open(os.path.join(modelPath, model + '.cif'), 'w') as file:
+                file.write(text)
+            db.execute('insert into alpha.af_id (id, genome_id, protein_id) values (?, ?, ?)',
+                       (afID, PROTEOME, model))
+            db.executemany('insert into alpha.protein_coord (af_id, atom_number, protein_atom, residue_type, chain, '
+                           'residue_sequence, x_coord, y_coord, z_coord, occupancy, b_factor, element) '
+                           'values ({:d}, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(afID), coords)
+            db.executemany('insert into alpha.cs_prediction (af_id, csp_id, protein_atom, res_sequence, exp_id, '
+                           'chemical_shift, res_name) values (?, ?, ?, ?, ?, ?, ?)',
+                           synthetic_predictions(rng=rng, afID=afID, coords=coords, predictors=predictors))
+        if protein % 1000 == 0:
+            db.commit()
+            print('generated {:d} of {:d} proteins'.format(protein, proteins))
+    db.executescript(INDEXES)
+    db.commit()
+    db.close()
+
+    with open(manifestFile, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    print('generated {:d} proteins ({:d} models) in {:.1f} s'.format(proteins, afID, time.monotonic() - start))
+    return manifest
+
+
+def fill_std_predictions(benchCfg, dbFile, batchSize=200):
+    """
+    Fill alpha.cs_prediction_std of the stand-in with the rows of Q_compareCSP_batch, for --shiftSource table
+    """
+    registry = augment.load_query_registry(cfgFile=benchCfg)
+    template = registry.template('compareCSP_batch')
+    session = sqliteSession(filename=dbFile)
+    session.query('delete from alpha.cs_prediction_std')
+    session.query('delete from alpha.cs_prediction_std_state')
+    afIDs = [row[0] for row in session.query('select id from alpha.af_id order by id')]
+    cspIDs = ', '.join(str(row[0]) for row in session.query('select id from alpha.cs_predictor order by id'))
+    for batch in augment.chunked(afIDs, size=batchSize):
+        rows = session.query(template.render({'%%%AFIDS%%%': ', '.join(str(afID) for afID in batch),
+                                              '%%%CSPIDS%%%': cspIDs}))
+        session.db.executemany('insert into alpha.cs_prediction_std (af_id, csp_id, res_sequence, residue_type, '
+                               'atom, chemical_shift) values (?, ?, ?, ?, ?, ?)', rows)
+        session.db.executemany('insert into alpha.cs_prediction_std_state (af_id) values (?)',
+                               [(afID,) for afID in batch])
+        session.db.commit()
+    session.close()
+
+
+def write_mapping(workDir, proteins, fragments):
+    """
+    Write the mapping file of the first proteins of the dataset (one made-up BMRB id per model) and the BMRB to
+    PDB table, so mappingIndex never asks the BMRB
+    :return: mapping file and PDB table paths
+    """
+    mappingFile = os.path.join(workDir, 'mapping_{:d}.txt'.format(proteins))
+    pdbTable = os.path.join(workDir, 'bmrb_pdb.json')
+    pdbIDs = OrderedDict()
+    with open(mappingFile, 'w') as file:
+        for protein in range(1, proteins + 1):
+            _, models = model_names(protein, fragments)
+            for frag, model in enumerate(models):
+                bmrbID = str(50000 + protein * fragments + frag)
+                pdbIDs[bmrbID] = '{:d}B{:02X}'.format(protein % 10, (protein * fragments + frag) % 256)
+                file.write("/reboxitory/alphafold/{}/{}.pdb ['{}']\n".format(PROTEOME, model, bmrbID))
+    with open(pdbTable, 'w') as file:
+        json.dump(pdbIDs, file, indent=1)
+    return mappingFile, pdbTable
+
+
+def run_size(workDir, proteins, shiftSource, augmentArgs, poolSize):
+    """
+    Augment the first proteins of the dataset with augmentAlphaFoldmmCIF.main against the stand-in, in this
+    process, and write the run summary to workDir/result_<proteins>.json
+    """
+    benchCfg = os.path.join(workDir, 'bench.cfg')
+    dbFile = os.path.join(workDir, 'alpha.sqlite')
+    with open(os.path.join(workDir, 'dataset.json')) as file:
+        manifest = json.load(file)
+    mappingFile, pdbTable = write_mapping(workDir=workDir, proteins=proteins, fragments=manifest['fragments'])
+    outputPath = os.path.join(workDir, 'out_{:d}'.format(proteins))
+    shutil.rmtree(outputPath, ignore_errors=True)
+    os.makedirs(outputPath)
+
+    install_sqlite_pools(cfgFile=benchCfg, dbFile=dbFile, size=poolSize)
+    augment.init_worker = functools.partial(init_sqlite_worker, cfgFile=benchCfg, dbFile=dbFile, size=poolSize)
+    sys.argv = ['augmentAlphaFoldmmCIF.py', '--cfg_file', benchCfg, '--afPath', os.path.join(workDir, 'alphafold'),
+                '--outputPath', outputPath, '--mappingFile', mappingFile, '--fromMapping',
+                '--bmrbPdbTable', pdbTable, '--shiftSource', shiftSource] + augmentArgs
+    start = time.monotonic()
+    augment.main()
+    wall = time.monotonic() - start
+
+    stages, rates = augment.metrics.summary()
+    result = OrderedDict([('proteins', proteins), ('files', rates['files']),
+                          ('status', dict(augment.metrics.status)), ('wall', wall), ('elapsed', rates['elapsed']),
+                          ('files_per_sec', rates['proteins_per_sec']), ('atoms_per_sec', rates['atoms_per_sec']),
+                          # ru_maxrss is in kilobytes on Linux, RUSAGE_CHILDREN covers the --workers processes
+                          ('peak_rss_mb', max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024),
+                          ('totals', dict(augment.metrics.totals)), ('stages', stages)])
+    with open(os.path.join(workDir, 'result_{:d}.json'.format(proteins)), 'w') as file:
+        json.dump(result, file, indent=1)
+
+
+def print_results(results, shiftSource, baseline=None):
+    """
+    Print the throughput of every size and the stage percentiles (ms), with the files/s ratio to a baseline.
+    A shift source other than the augmentAlphaFoldmmCIF.py default, or than the baseline's, is called out
+    """
+    if shiftSource != augment.DEFAULT_SHIFT_SOURCE:
+        print('shift source {} (augmentAlphaFoldmmCIF.py defaults to {})'.format(shiftSource,
+                                                                            augment.DEFAULT_SHIFT_SOURCE))
+    if baseline is not None and baseline.get('shift_source') != shiftSource:
+        print('the baseline ran with shift source {}, its files/s are not comparable'.format(
+            baseline.get('shift_source')))
+    baseRuns = {run['proteins']: run for run in (baseline or {}).get('runs', [])}
+    print('{:>9} {:>7} {:>9} {:>11} {:>12}{}'.format('proteins', 'files', 'files/s', 'atoms/s', 'peak RSS MB',
+                                                    ' {:>9}'.format('vs base') if baseRuns else ''))
+    for run in results:
+        ratio = ''
+        if run['proteins'] in baseRuns and baseRuns[run['proteins']]['files_per_sec']:
+            ratio = ' {:>8.2f}x'.format(run['files_per_sec'] / baseRuns[run['proteins']]['files_per_sec'])
+        print('{:>9d} {:>7d} {:>9.2f} {:>11.0f} {:>12.1f}{}'.format(
+            run['proteins'], run['files'], run['files_per_sec'], run['atoms_per_sec'], run['peak_rss_mb'], ratio))
+    for run in results:
+        print('\n{:d} proteins, stage times in ms'.format(run['proteins']))
+        print('{:<12} {:>8} {:>9} {:>9} {:>9}'.format('stage', 'n', 'p50', 'p95', 'p99'))
+        for stage, values in run['stages'].items():
+            print('{:<12} {:>8d} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                stage, values['count'], values['p50'] * 1000, values['p95'] * 1000, values['p99'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark augmentAlphaFoldmmCIF on synthetic AlphaFold models '
+                                                 'against a local SQLite stand-in of the alpha schema')
+    parser.add_argument('--cfg_file', help='cfg file whose queries are benchmarked', default='alphaFold.cfg')
+    parser.add_argument('--workDir', help='directory of the dataset, outputs and results', required=True)
+    parser.add_argument('--sizes', help='comma separated numbers of proteins to augment', default='1,100,10000')
+    parser.add_argument('--fragments', help='models (F1, F2, ...) per protein', type=int, default=1)
+    parser.add_argument('--residues', help='residues per model', type=int, default=150)
+    parser.add_argument('--predictors', help='comma separated chemical shift predictor ids with predictions',
+                        default='1,2,8')
+    parser.add_argument('--seed', help='random seed of the dataset', type=int, default=1)
+    parser.add_argument('--shiftSource', help='--shiftSource of the augment runs (default client, not the query '
+                                              'default of augmentAlphaFoldmmCIF.py). SQLite does not reduce the '
+                                              'full outer join of Q_compareCSP to a left join as PostgreSQL does, '
+                                              'so query scans alpha.cs_prediction for every file on the stand-in',
+                        choices=list(augment.SHIFT_SOURCES), default='client')
+    parser.add_argument('--augmentArgs', help='extra augmentAlphaFoldmmCIF arguments, given in the = form so '
+                                              'they are not read as benchmark options, e.g. '
+                                              '--augmentArgs="--workers 4" or --augmentArgs="--pipeline"',
+                        default='')
+    parser.add_argument('--poolSize', help='stand-in connections per database', type=int, default=4)
+    parser.add_argument('--report', help='JSON file of the results (default: benchmark.json in --workDir)',
+                        default=None)
+    parser.add_argument('--baseline', help='earlier --report to compare files/s with', default=None)
+    parser.add_argument('--runSize', help=argparse.SUPPRESS, type=int, default=None)
+
+    args = parser.parse_args()
+    augmentArgs = shlex.split(args.augmentArgs)
+    os.makedirs(args.workDir, exist_ok=True)
+
+    if args.runSize is not None:
+        run_size(workDir=args.workDir, proteins=args.runSize, shiftSource=args.shiftSource,
+                 augmentArgs=augmentArgs, poolSize=args.poolSize)
+        return
+
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    predictors = [int(cspID) for cspID in args.predictors.split(',')]
+    manifest = generate_dataset(workDir=args.workDir, proteins=sizes[-1], fragments=args.fragments,
+                                residues=args.residues, predictors=predictors, seed=args.seed)
+    benchCfg = os.path.join(args.workDir, 'bench.cfg')
+    dbFile = os.path.join(args.workDir, 'alpha.sqlite')
+    write_benchmark_cfg(cfgFile=args.cfg_file, benchCfg=benchCfg, dbFile=dbFile)
+    if args.shiftSource == 'table':
+        fill_std_predictions(benchCfg=benchCfg, dbFile=dbFile)
+
+    results = []
+    for size in sizes:
+        # one process per size, so peak RSS and module state belong to that run alone
+        logFile = os.path.join(args.workDir, 'run_{:d}.log'.format(size))
+        print('augmenting {:d} proteins (log in {})'.format(size, logFile))
+        with open(logFile, 'w') as log:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--workDir', args.workDir,
+                            '--runSize', str(size), '--shiftSource', args.shiftSource,
+                            '--augmentArgs=' + args.augmentArgs, '--poolSize', str(args.poolSize)],
+                           stdout=log, stderr=subprocess.STDOUT, check=True)
+        with open(os.path.join(args.workDir, 'result_{:d}.json'.format(size))) as file:
+            results.append(json.load(file))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results=results, shiftSource=args.shiftSource, baseline=baseline)
+
+    report = OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('dataset', manifest),
+                          ('shift_source', args.shiftSource), ('default_shift_source', augment.DEFAULT_SHIFT_SOURCE),
+                          ('augment_args', args.augmentArgs),
+                          ('python', platform.python_version()), ('sqlite', sqlite3.sqlite_version),
+                          ('machine', platform.machine()), ('cpus', os.cpu_count()), ('runs', results)])
+    with open(args.report or os.path.join(args.workDir, 'benchmark.json'), 'w') as file:
+        json.dump(report, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
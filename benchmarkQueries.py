@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+
+import augmentAlphaFoldmmCIF as augment
+from benchmarkAugment import generate_dataset, sqliteSession, write_benchmark_cfg
+
+# statements that only read, the others (inserts, COPY, deletes, DDL) are not run
+READ_STATEMENTS = ('select', 'with')
+# plan nodes that read a whole table
+PG_SCAN_NODES = ('Seq Scan', 'Parallel Seq Scan')
+SQLITE_SCAN = re.compile(r'^SCAN (?:alpha\.)?(\w+)')
+TABLE_ALIAS = re.compile(r'\b(?:from|join)\s+alpha\.(\w+)(?:\s+(?:as\s+)?(?!where\b|on\b|join\b|left\b|right\b|'
+                         r'full\b|inner\b|outer\b|order\b|group\b|union\b)(\w+))?', re.IGNORECASE)
+
+
+def is_read_query(text):
+    words = text.split(None, 1)
+    return bool(words) and words[0].lower() in READ_STATEMENTS
+
+
+def table_aliases(text):
+    """
+    Map the aliases (and names) of the alpha tables of a query to their table, SQLite plans name tables by alias
+    """
+    aliases = dict()
+    for table, alias in TABLE_ALIAS.findall(text):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+class sampleValues:
+    """
+    Representative values for the placeholders of the Q_ sections, drawn from the rows of the database
+    """
+
+    def __init__(self, backend, batch=50, seed=1):
+        self.rng = random.Random(seed)
+        self.batch = batch
+        self.afRows = [tuple(row) for row in backend.run('select id, genome_id, protein_id from alpha.af_id '
+                                                         'order by id')]
+        self.cspRows = [tuple(row) for row in backend.run('select id, csp_name from alpha.cs_predictor '
+                                                          'order by id')]
+        if not self.afRows or not self.cspRows:
+            raise ValueError('alpha.af_id and alpha.cs_predictor need rows to draw query values from')
+
+    def subs(self):
+        afID, genomeID, proteinID = self.rng.choice(self.afRows)
+        cspID, cspName = self.rng.choice(self.cspRows)
+        batch = self.rng.sample(self.afRows, min(self.batch, len(self.afRows)))
+        return {'%%%AFID%%%': afID, '%%%GENOMEID%%%': genomeID, '%%%PROTEINID%%%': proteinID, '%%%CHAIN%%%': 'A',
+                '%%%CSPID%%%': cspID, '%%%CSP%%%': cspName,
+                '%%%CSPIDS%%%': ', '.join(str(row[0]) for row in self.cspRows),
+                '%%%AFIDS%%%': ', '.join(str(row[0]) for row in sorted(batch)),
+                '%%%MAXID%%%': max(self.afRows[-1][0] - self.batch, 0), '%%%PH%%%': 7.0, '%%%TEMP%%%': 298.0}
+
+
+class sqliteBackend:
+    """
+    Query latency and EXPLAIN QUERY PLAN on the SQLite stand-in
+    """
+    name = 'sqlite'
+
+    def __init__(self, dbFile):
+        self.session = sqliteSession(filename=dbFile)
+
+    def table_rows(self):
+        tables = [row[0] for row in self.session.query("select name from alpha.sqlite_master where type = 'table'")]
+        return {table: self.session.query('select count(*) from alpha.{}'.format(table))[0][0] for table in tables}
+
+    def run(self, text):
+        return self.session.query(text)
+
+    def explain(self, text, tableRows, largeRows):
+        """
+        :return: plan text and the full scans of large tables
+        """
+        plan = self.session.query('explain query plan ' + text)
+        aliases = table_aliases(text)
+        scans = []
+        for row in plan:
+            match = SQLITE_SCAN.match(row[3])
+            table = aliases.get(match.group(1)) if match else None
+            if table is not None and tableRows.get(table, 0) >= largeRows:
+                scans.append(OrderedDict([('table', table), ('rows', tableRows[table]), ('detail', row[3])]))
+        return '\n'.join(row[3] for row in plan), scans
+
+    def plan_times(self, template, values, repeat):
+        # SQLite does not report planning time
+        return None
+
+    def close(self):
+        self.session.close()
+
+
+class postgresBackend:
+    """
+    Query latency and EXPLAIN (ANALYZE, BUFFERS) on the PostgreSQL database of the cfg file
+    """
+    name = 'postgres'
+
+    def __init__(self, registry, dbSection_name):
+        # one pooled session for the whole run, so every query sees the same warm connection
+        self.borrowed = augment.get_pool(dbSection_name=dbSection_name,
+                                         dbSection=registry.cfg.get(dbSection_name)).session()
+        self.conn = self.borrowed.__enter__()
+
+    def table_rows(self):
+        rows = self.conn.query("select c.relname, c.reltuples::bigint from pg_class c "
+                               "join pg_namespace n on n.oid = c.relnamespace "
+                               "where n.nspname = 'alpha' and c.relkind = 'r'")
+        return {table: count for table, count in rows}
+
+    def run(self, text):
+        return self.conn.query(text)
+
+    def explain(self, text, tableRows, largeRows):
+        plan = self.conn.query('explain (analyze, buffers, format json) ' + text)[0][0][0]
+        scans = []
+        nodes = [plan['Plan']]
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', []))
+            table = node.get('Relation Name')
+            if node['Node Type'] in PG_SCAN_NODES and tableRows.get(table, 0) >= largeRows:
+                scans.append(OrderedDict([('table', table), ('rows', tableRows[table]),
+                                          ('detail', '{} on {} ({} rows removed by filter)'.format(
+                                              node['Node Type'], table, node.get('Rows Removed by Filter', 0)))]))
+        return plan, scans
+
+    def plan_times(self, template, values, repeat):
+        """
+        Median planning time (ms) of the query sent as text and, when it has one, of its prepared statement. The
+        server plans a prepared statement for its first executions and then reuses a generic plan when that is
+        no worse, which repeat runs on the same session show
+        :return: OrderedDict of plan_ms and prepared_plan_ms (None when the query is not prepared)
+        """
+        textTimes = []
+        preparedTimes = []
+        statement = template.statement
+        for _ in range(repeat):
+            subs = values.subs()
+            textTimes.append(self.conn.query('explain (summary, format json) ' +
+                                             template.render(subs))[0][0][0]['Planning Time'])
+            params = template.parameters(subs)
+            if params is not None and self.conn.prepare(statement):
+                preparedTimes.append(self.conn.query(
+                    'explain (summary, format json) execute {} ({})'.format(
+                        statement.name, ', '.join(['%s'] * len(params))), params)[0][0][0]['Planning Time'])
+        return OrderedDict([('plan_ms', augment.percentile(sorted(textTimes), 50)),
+                            ('prepared_plan_ms', augment.percentile(sorted(preparedTimes), 50))])
+
+    def close(self):
+        self.borrowed.__exit__(None, None, None)
+
+
+def benchmark_query(backend, template, values, repeat, tableRows, largeRows):
+    """
+    Time repeat runs of one query with fresh placeholder values and capture its plan
+    :return: OrderedDict of latencies (ms), rows and plan
+    """
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        text = template.render(values.subs())
+        start = time.perf_counter()
+        rows = len(backend.run(text))
+        latencies.append((time.perf_counter() - start) * 1000)
+    plan, scans = backend.explain(template.render(values.subs()), tableRows=tableRows, largeRows=largeRows)
+    latencies.sort()
+    result = OrderedDict([('rows', rows), ('runs', repeat)])
+    result.update(('p{:d}'.format(q), augment.percentile(latencies, q)) for q in (50, 95, 99))
+    result.update(max=latencies[-1])
+    result.update(backend.plan_times(template=template, values=values, repeat=repeat) or {})
+    result.update(seq_scans=scans, plan=plan)
+    return result
+
+
+def benchmark_queries(backend, registry, values, repeat, largeRows, only=None):
+    """
+    Run every read query of the registry
+    :return: OrderedDict of query name -> result (or error / skipped reason) and the table row counts
+    """
+    tableRows = backend.table_rows()
+    results = OrderedDict()
+    for name, template in registry.templates.items():
+        if only and not re.search(only, name):
+            continue
+        if not is_read_query(template.render()):
+            results[name] = OrderedDict([('skipped', 'not a read query')])
+            continue
+        try:
+            results[name] = benchmark_query(backend=backend, template=template, values=values, repeat=repeat,
+                                            tableRows=tableRows, largeRows=largeRows)
+        except Exception as e:
+            results[name] = OrderedDict([('error', str(e).strip())])
+    return results, tableRows
+
+
+def print_query_results(results, baseline=None, regression=1.5):
+    """
+    Print the latency of every query, its full scans of large tables and its p50 ratio to a baseline
+    """
+    baseQueries = (baseline or {}).get('queries', {})
+    print('{:<30} {:>9} {:>10} {:>10} {:>10}  {}'.format('query', 'rows', 'p50 ms', 'p95 ms', 'max ms', 'notes'))
+    for name, result in results.items():
+        if 'skipped' in result:
+            continue
+        if 'error' in result:
+            print('{:<30} {}'.format(name, 'error: ' + result['error'].splitlines()[0]))
+            continue
+        notes = ['seq scan ' + ', '.join(sorted({scan['table'] for scan in result['seq_scans']}))] \
+            if result['seq_scans'] else []
+        if result.get('plan_ms') is not None:
+            notes.append('plan {:.2f} ms'.format(result['plan_ms']) + (
+                ', prepared {:.2f} ms'.format(result['prepared_plan_ms'])
+                if result['prepared_plan_ms'] is not None else ''))
+        base = baseQueries.get(name, {})
+        if base.get('p50'):
+            ratio = result['p50'] / base['p50']
+            notes.append('{:.2f}x base{}'.format(ratio, ' REGRESSION' if ratio >= regression else ''))
+        print('{:<30} {:>9d} {:>10.2f} {:>10.2f} {:>10.2f}  {}'.format(
+            name, result['rows'], result['p50'], result['p95'], result['max'], '; '.join(notes)))
+    skipped = [name for name, result in results.items() if 'skipped' in result]
+    if skipped:
+        print('not run (writes, COPY or DDL): {}'.format(', '.join(skipped)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every read query of the cfg file with representative '
+                                                 'values, capture its plan and flag full scans of large tables')
+    parser.add_argument('--cfg_file', help='cfg file whose Q_ sections are benchmarked', default='alphaFold.cfg')
+    parser.add_argument('--backend', help='sqlite: synthetic data in a SQLite stand-in (EXPLAIN QUERY PLAN); '
+                                          'postgres: the database of the cfg file, e.g. a throwaway server loaded '
+                                          'with ingestAlphaFoldCS.py (EXPLAIN (ANALYZE, BUFFERS))',
+                        choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--workDir', help='directory of the stand-in dataset and the report (sqlite backend)',
+                        default=None)
+    parser.add_argument('--proteins', help='proteins of the synthetic dataset', type=int, default=1000)
+    parser.add_argument('--fragments', help='models (F1, F2, ...) per protein', type=int, default=1)
+    parser.add_argument('--residues', help='residues per model', type=int, default=150)
+    parser.add_argument('--predictors', help='comma separated chemical shift predictor ids with predictions',
+                        default='1,2,8')
+    parser.add_argument('--seed', help='random seed of the dataset and of the query values', type=int, default=1)
+    parser.add_argument('--repeat', help='runs of each query', type=int, default=10)
+    parser.add_argument('--batch', help='af_ids substituted for %%%%%%AFIDS%%%%%%', type=int, default=50)
+    parser.add_argument('--largeRows', help='rows from which a table is large and a full scan of it is flagged',
+                        type=int, default=10000)
+    parser.add_argument('--only', help='regular expression of the query names to run', default=None)
+    parser.add_argument('--report', help='JSON file of the latencies and plans (default: queries.json in '
+                                         '--workDir)', default=None)
+    parser.add_argument('--baseline', help='earlier --report to compare p50 latencies with', default=None)
+    parser.add_argument('--regression', help='p50 ratio to the baseline flagged as a regression', type=float,
+                        default=1.5)
+
+    args = parser.parse_args()
+    manifest = None
+    if args.backend == 'sqlite':
+        if args.workDir is None:
+            parser.error('--backend sqlite needs --workDir')
+        os.makedirs(args.workDir, exist_ok=True)
+        manifest = generate_dataset(workDir=args.workDir, proteins=args.proteins, fragments=args.fragments,
+                                    residues=args.residues,
+                                    predictors=[int(cspID) for cspID in args.predictors.split(',')], seed=args.seed)
+        dbFile = os.path.join(args.workDir, 'alpha.sqlite')
+        cfgFile = os.path.join(args.workDir, 'bench.cfg')
+        write_benchmark_cfg(cfgFile=args.cfg_file, benchCfg=cfgFile, dbFile=dbFile)
+        registry = augment.load_query_registry(cfgFile=cfgFile)
+        backend = sqliteBackend(dbFile=dbFile)
+    else:
+        if args.report is None:
+            parser.error('--backend postgres needs --report')
+        registry = augment.load_query_registry(cfgFile=args.cfg_file)
+        backend = postgresBackend(registry=registry, dbSection_name=registry.template('selectAll_afID').database)
+
+    try:
+        values = sampleValues(backend=backend, batch=args.batch, seed=args.seed)
+        results, tableRows = benchmark_queries(backend=backend, registry=registry, values=values,
+                                               repeat=args.repeat, largeRows=args.largeRows, only=args.only)
+    finally:
+        backend.close()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print('table rows: {}'.format(', '.join('{}={}'.format(k, v) for k, v in sorted(tableRows.items()))))
+    print_query_results(results=results, baseline=baseline, regression=args.regression)
+
+    report = OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('backend', backend.name),
+                          ('dataset', manifest), ('table_rows', tableRows), ('repeat', args.repeat),
+                          ('batch', args.batch), ('python', platform.python_version()),
+                          ('sqlite', sqlite3.sqlite_version), ('queries', results)])
+    with open(args.report or os.path.join(args.workDir, 'queries.json'), 'w') as file:
+        json.dump(report, file, indent=1, default=str)
+
+
+if __name__ == '__main__':
+    main()
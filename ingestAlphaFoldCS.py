@@ -0,0 +1,376 @@
+import argparse
+import csv
+import io
+import os
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+from augmentAlphaFoldmmCIF import afIDIndex, chunked, get_pool, load_query_registry, open_cif, \
+    report_pool_metrics, searchPathExt, timedomain
+
+
+def copy_value(val):
+    """
+    Render a value as a field of COPY text format
+    """
+    if val is None:
+        return '\\N'
+    if isinstance(val, str):
+        return val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(val)
+
+
+def copy_rows(cur, copySQL, rows, chunkRows=50000):
+    """
+    Stream rows into a table with COPY FROM STDIN, sending one COPY per chunk so memory stays bounded
+    :param cur: cursor of the transaction to load in
+    :param copySQL: COPY ... FROM STDIN statement
+    :param rows: iterable of tuples, in the column order of copySQL
+    :param chunkRows: rows per COPY
+    :return: number of rows loaded
+    """
+    count = 0
+    buf = io.StringIO()
+    inChunk = 0
+    for row in rows:
+        buf.write('\t'.join(copy_value(val) for val in row))
+        buf.write('\n')
+        inChunk += 1
+        if inChunk == chunkRows:
+            buf.seek(0)
+            cur.copy_expert(copySQL, buf)
+            count += inChunk
+            buf = io.StringIO()
+            inChunk = 0
+    if inChunk:
+        buf.seek(0)
+        cur.copy_expert(copySQL, buf)
+        count += inChunk
+    return count
+
+
+def read_pdb_atoms(pdbFile, af_id):
+    """
+    Yield the alpha.protein_coord rows of a REDUCE protonated AlphaFold PDB file
+    :param pdbFile: path to a .pdb (or .pdb.gz) file
+    :param af_id: alpha.af_id id of the model
+    :return: generator of tuples in Q_copyProteinCoord column order
+    """
+    with open_cif(pdbFile) as file:
+        for line in file:
+            if not line.startswith(('ATOM  ', 'HETATM')):
+                continue
+            occupancy = line[54:60].strip()
+            b_factor = line[60:66].strip()
+            yield (af_id,
+                   int(line[6:11]),
+                   line[12:16].strip(),
+                   line[17:20].strip(),
+                   line[21:22].strip(),
+                   int(line[22:26]),
+                   float(line[30:38]),
+                   float(line[38:46]),
+                   float(line[46:54]),
+                   float(occupancy) if occupancy else None,
+                   float(b_factor) if b_factor else None,
+                   line[76:78].strip() or None)
+
+
+def read_cs_table(csFile):
+    """
+    Read a chemical shift prediction table: CSV with a header row naming at least csp_name, res_sequence,
+    res_name, protein_atom and chemical_shift, and optionally the ph and temp of the prediction
+    :param csFile: path to a .csv file
+    :return: generator of dictionaries
+    """
+    with open_cif(csFile) as file:
+        for row in csv.DictReader(file):
+            yield row
+
+
+class ingestLookups:
+    """
+    Cached af_id, csp_id and exp_id lookups. Every id is queried (and inserted if missing) once per run.
+    csp_id and exp_id can run on the cursor of a load, so a new id commits or rolls back with the load
+    """
+
+    def __init__(self, cfgFile):
+        self.td = timedomain(cfgFile=cfgFile)
+        self.registry = load_query_registry(cfgFile=cfgFile)
+        self.afIndex = afIDIndex()
+        self.afIndex.load(rows=self.query_data(basename='selectAll_afID'))
+        self.cspIDs = {row['csp_name']: row['id'] for row in self.query_data(basename='selectAll_cspID')}
+        self.expIDs = dict()
+        # (cache, key) of the ids looked up in the open load transaction
+        self.uncommitted = []
+
+    def query_data(self, basename, subs=None):
+        result = self.td.query(basename=basename, subs=subs)
+        if result is None:
+            raise RuntimeError('query {:s} failed'.format('Q_' + basename))
+        return result.data
+
+    def lookup(self, queryBasename, insertBasename, subs, cur=None):
+        """
+        Return the id of a row, inserting the row first when it does not exist yet
+        :param cur: cursor of an open transaction to run the queries on, instead of a pooled session that
+                    commits the insert on its own. The values are bound as parameters, a None as NULL
+        """
+        if cur is None:
+            rows = self.query_data(basename=queryBasename, subs=subs)
+            if not rows:
+                self.query_data(basename=insertBasename, subs=subs)
+                rows = self.query_data(basename=queryBasename, subs=subs)
+            return rows[0]['id']
+        cur.execute(*self.registry.template(queryBasename).bind(subs))
+        rows = cur.fetchall()
+        if not rows:
+            cur.execute(*self.registry.template(insertBasename).bind(subs))
+            cur.execute(*self.registry.template(queryBasename).bind(subs))
+            rows = cur.fetchall()
+        return rows[0][0]
+
+    def cached(self, cache, key, cur, **kwargs):
+        if key not in cache:
+            cache[key] = self.lookup(cur=cur, **kwargs)
+            if cur is not None:
+                self.uncommitted.append((cache, key))
+        return cache[key]
+
+    def commit(self):
+        """
+        Keep the ids looked up on the cursor of a load that committed
+        """
+        self.uncommitted = []
+
+    def rollback(self):
+        """
+        Forget the ids looked up on the cursor of a load that rolled back, they may have been inserted by it
+        """
+        for cache, key in self.uncommitted:
+            cache.pop(key, None)
+        self.uncommitted = []
+
+    def af_id(self, genome_id, protein_id):
+        af_id = self.afIndex.get(genome_id=genome_id, protein_id=protein_id)
+        if af_id is None:
+            af_id = self.lookup(queryBasename='afID_Index', insertBasename='afIDInsert',
+                                subs={'%%%GENOMEID%%%': genome_id, '%%%PROTEINID%%%': protein_id})
+            self.afIndex.load(rows=[{'id': af_id, 'genome_id': genome_id, 'protein_id': protein_id}])
+        return af_id
+
+    def csp_id(self, csp_name, cur=None):
+        return self.cached(cache=self.cspIDs, key=csp_name, cur=cur, queryBasename='queryCSPindex',
+                           insertBasename='insertCSPlist', subs={'%%%CSP%%%': csp_name})
+
+    def exp_id(self, ph, temp, cur=None):
+        # Q_queryExpCond matches a missing pH or temperature with is null
+        return self.cached(cache=self.expIDs, key=(ph, temp), cur=cur, queryBasename='queryExpCond',
+                           insertBasename='insertExpCond', subs={'%%%PH%%%': ph, '%%%TEMP%%%': temp})
+
+
+def optional_float(val):
+    if val is None or val.strip() in ('', '.', '?'):
+        return None
+    return float(val)
+
+
+def cs_rows(csFile, af_id, lookups, cur):
+    """
+    Yield the alpha.cs_prediction rows of a chemical shift prediction table
+    :param cur: cursor of the load, new csp_id and exp_id rows are inserted in its transaction
+    :return: generator of tuples in Q_copyCSPrediction column order
+    """
+    for row in read_cs_table(csFile):
+        yield (af_id,
+               lookups.csp_id(row['csp_name'], cur=cur),
+               row['protein_atom'],
+               int(row['res_sequence']),
+               lookups.exp_id(ph=optional_float(row.get('ph')), temp=optional_float(row.get('temp')), cur=cur),
+               float(row['chemical_shift']),
+               row['res_name'])
+
+
+def model_key(path):
+    """
+    (genome_id, protein_id) of a file laid out as <proteome>/<model>.<ext>[.gz]
+    """
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return Path(path).parts[-2], os.path.splitext(name)[0]
+
+
+def find_files(inputPath, extension):
+    if inputPath is None:
+        return []
+    if os.path.isfile(inputPath):
+        return [inputPath]
+    return searchPathExt(inputPath=inputPath, extension=(extension, extension + '.gz'))
+
+
+def pair_models(pdbPath, csPath):
+    """
+    Pair the protonated coordinate file and the chemical shift table of each model
+    :return: generator of ((genome_id, protein_id), pdb file or None, cs file or None)
+    """
+    csFiles = OrderedDict((model_key(f), f) for f in find_files(csPath, '.csv'))
+    for pdbFile in find_files(pdbPath, '.pdb'):
+        key = model_key(pdbFile)
+        yield key, pdbFile, csFiles.pop(key, None)
+    for key, csFile in csFiles.items():
+        yield key, None, csFile
+
+
+class ingestStats:
+    """
+    Running totals of a load, reported as rows and proteins per second
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.counts = OrderedDict([('proteins', 0), ('failed', 0), ('coord_rows', 0), ('cs_rows', 0)])
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        rows = self.counts['coord_rows'] + self.counts['cs_rows']
+        print('ingested {:d} proteins ({:d} failed), {:d} coordinate rows, {:d} shift rows in {:.1f} s: '
+              '{:.1f} proteins/s, {:.0f} rows/s'.format(
+                self.counts['proteins'], self.counts['failed'], self.counts['coord_rows'],
+                self.counts['cs_rows'], elapsed, self.counts['proteins'] / elapsed, rows / elapsed))
+
+
+def ingest_model(pool, registry, lookups, key, pdbFile, csFile, chunkRows=50000, replace=False):
+    """
+    Load the coordinates and chemical shifts of one model in a single transaction. Once Q_createStdPredictions
+    has run, its triggers mark the standardized predictions of the model as pending in the same transaction
+    :return: (coordinate rows, shift rows) loaded
+    """
+    af_id = lookups.af_id(genome_id=key[0], protein_id=key[1])
+    subs = {'%%%AFID%%%': af_id}
+    coordCount = csCount = 0
+    with pool.session() as conn:
+        cur = conn.conn.cursor()
+        try:
+            if replace:
+                if pdbFile is not None:
+                    cur.execute(registry.template('deleteProteinCoord').render(subs))
+                if csFile is not None:
+                    cur.execute(registry.template('deleteCSPrediction').render(subs))
+            if pdbFile is not None:
+                coordCount = copy_rows(cur=cur, copySQL=registry.template('copyProteinCoord').render(),
+                                       rows=read_pdb_atoms(pdbFile, af_id), chunkRows=chunkRows)
+            if csFile is not None:
+                csCount = copy_rows(cur=cur, copySQL=registry.template('copyCSPrediction').render(),
+                                    rows=cs_rows(csFile, af_id, lookups, cur), chunkRows=chunkRows)
+            conn.conn.commit()
+        except BaseException:
+            conn.conn.rollback()
+            lookups.rollback()
+            raise
+    lookups.commit()
+    return coordCount, csCount
+
+
+def refresh_std_predictions(cfgFile, batchSize=200):
+    """
+    Create alpha.cs_prediction_std if needed and fill in the standardized predictions of every protein that
+    has predictions but no current standardized rows, batchSize proteins per transaction. Each transaction
+    share locks the tables it reads, so loads wait for it rather than commit rows it has already standardized
+    :param cfgFile: cfg filename
+    :param batchSize: proteins refreshed per transaction
+    :return: number of proteins refreshed
+    """
+    td = timedomain(cfgFile=cfgFile)
+    if td.query(basename='createStdPredictions') is None:
+        raise RuntimeError('could not create alpha.cs_prediction_std')
+    pending = [row['id'] for row in td.query(basename='pendingStdPredictions').data]
+    print('{:d} proteins pending in alpha.cs_prediction_std'.format(len(pending)))
+
+    start = time.monotonic()
+    refreshed = 0
+    for batch in chunked(pending, size=batchSize):
+        result = td.query(basename='refreshStdPredictions',
+                          subs={'%%%AFIDS%%%': ', '.join(str(int(af_id)) for af_id in batch)})
+        if result is None:
+            print('failed to refresh af_ids {:d} to {:d}'.format(batch[0], batch[-1]))
+            continue
+        refreshed += len(batch)
+        print('refreshed {:d} of {:d} proteins in {:.1f} s'.format(refreshed, len(pending),
+                                                                   time.monotonic() - start))
+    return refreshed
+
+
+def ingest(cfgFile, pdbPath=None, csPath=None, chunkRows=50000, replace=False, reportEvery=100):
+    """
+    Bulk load REDUCE protonated coordinates into alpha.protein_coord and predicted chemical shifts into
+    alpha.cs_prediction, one transaction per model
+    :param cfgFile: cfg filename
+    :param pdbPath: protonated .pdb file or directory of <proteome>/<model>.pdb files
+    :param csPath: prediction table or directory of <proteome>/<model>.csv tables
+    :param chunkRows: rows sent per COPY
+    :param replace: delete the rows already loaded for a model in the same transaction
+    :param reportEvery: proteins between throughput reports
+    :return: ingestStats
+    """
+    registry = load_query_registry(cfgFile=cfgFile)
+    dbSection_name = registry.template('copyProteinCoord').database
+    pool = get_pool(dbSection_name=dbSection_name, dbSection=registry.cfg.get(dbSection_name))
+    lookups = ingestLookups(cfgFile=cfgFile)
+    stats = ingestStats()
+
+    for key, pdbFile, csFile in pair_models(pdbPath=pdbPath, csPath=csPath):
+        try:
+            coordCount, csCount = ingest_model(pool=pool, registry=registry, lookups=lookups, key=key,
+                                               pdbFile=pdbFile, csFile=csFile, chunkRows=chunkRows,
+                                               replace=replace)
+        except Exception:
+            stats.counts['failed'] += 1
+            print('failed {:s}/{:s}'.format(*key))
+            traceback.print_exc()
+            continue
+        stats.counts['proteins'] += 1
+        stats.counts['coord_rows'] += coordCount
+        stats.counts['cs_rows'] += csCount
+        if reportEvery and stats.counts['proteins'] % reportEvery == 0:
+            stats.report()
+    stats.report()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load protonated AlphaFold coordinates and predicted '
+                                                 'chemical shifts with COPY')
+    parser.add_argument('--cfg_file', help='cfg filename', required=True)
+    parser.add_argument('--pdbPath', help='REDUCE protonated .pdb file or directory of <proteome>/<model>.pdb '
+                                          'files, loaded into alpha.protein_coord', default=None)
+    parser.add_argument('--csPath', help='chemical shift table or directory of <proteome>/<model>.csv tables '
+                                         '(columns csp_name, res_sequence, res_name, protein_atom, '
+                                         'chemical_shift and optionally ph, temp), loaded into '
+                                         'alpha.cs_prediction', default=None)
+    parser.add_argument('--chunkRows', help='rows sent per COPY', type=int, default=50000)
+    parser.add_argument('--replace', help='delete the rows already loaded for a model before loading it',
+                        action='store_true')
+    parser.add_argument('--reportEvery', help='proteins between throughput reports', type=int, default=100)
+    parser.add_argument('--refreshStd', help='bring alpha.cs_prediction_std up to date after loading (or on its '
+                                             'own, without --pdbPath and --csPath). Loads always mark the '
+                                             'proteins they touch as pending, this only runs the rebuild now',
+                        action='store_true')
+    parser.add_argument('--refreshBatch', help='proteins refreshed per transaction', type=int, default=200)
+
+    args = parser.parse_args()
+    if args.pdbPath is None and args.csPath is None and not args.refreshStd:
+        parser.error('nothing to do, give --pdbPath and/or --csPath, or --refreshStd')
+
+    if args.pdbPath is not None or args.csPath is not None:
+        ingest(cfgFile=args.cfg_file, pdbPath=args.pdbPath, csPath=args.csPath, chunkRows=args.chunkRows,
+               replace=args.replace, reportEvery=args.reportEvery)
+    if args.refreshStd:
+        refresh_std_predictions(cfgFile=args.cfg_file, batchSize=args.refreshBatch)
+    report_pool_metrics()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+The helper modules under resources/ ship with the BMRB tooling, not with this repository. When they are not on
+the path, stand-ins for the two functions augmentAlphaFoldmmCIF imports are registered so the writers can be tested
+"""
+import importlib.util
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def categoryName_loopNumber(loopsDict, categoryName):
+    for loopNum, loop in loopsDict.items():
+        if loop[0].split('.')[0] == categoryName:
+            return loopNum
+
+
+def bmrb2pdb_ID(bmrbID):
+    return []
+
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+if importlib.util.find_spec('resources') is None:
+    stub_module('resources', __path__=[])
+    stub_module('resources.mmCIF_support', categoryName_loopNumber=categoryName_loopNumber)
+    stub_module('resources.get_id', bmrb2pdb_ID=bmrb2pdb_ID)
@@ -0,0 +1,127 @@
+"""
+Regression test for the _atom_site writer: the loops print_aug_atom_site writes into an augmentedDocument must be
+byte for byte the file the original per-line writer appended to. data/atom_site_baseline.cif is the output of
+print_aug_atom_site at the baseline commit (593634d) for model_block(), protonated_atoms() and golden_shift_rows()
+"""
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('CifFile')
+pytest.importorskip('psycopg2')
+
+import augmentAlphaFoldmmCIF as augment
+
+GOLDEN_FILE = Path(__file__).parent / 'data' / 'atom_site_baseline.cif'
+CSP_IDS = [1, 2, 3, 4, 5, 6, 8]
+AF_ENTRY_NAME = 'AF-P12345-F1-model_v1'
+
+# heavy atoms of the model, the hydrogens are only in the protonated atom list
+RESIDUES = [('GLY', ['N', 'CA', 'C', 'O'], ['H', 'HA2', 'HA3']),
+            ('ALA', ['N', 'CA', 'C', 'O', 'CB'], ['H', 'HA', 'HB1', 'HB2', 'HB3']),
+            ('SER', ['N', 'CA', 'C', 'O', 'CB', 'OG'], ['H', 'HA', 'HB2', 'HB3', 'HG'])]
+XREF_DB_NUM_OFFSET = 7
+
+
+def model_block():
+    """
+    Synthetic AlphaFold model: three residues numbered from XREF_DB_NUM_OFFSET in the sifts columns
+    """
+    rows = []
+    for resNum, (resName, heavyAtoms, _) in enumerate(RESIDUES, start=1):
+        for atom in heavyAtoms:
+            n = len(rows) + 1
+            rows.append({
+                '_atom_site.group_pdb': 'ATOM', '_atom_site.id': str(n), '_atom_site.type_symbol': atom[0],
+                '_atom_site.label_atom_id': atom, '_atom_site.label_alt_id': '.', '_atom_site.label_comp_id': resName,
+                '_atom_site.label_asym_id': 'A', '_atom_site.label_entity_id': '1', '_atom_site.label_seq_id': str(resNum),
+                '_atom_site.pdbx_pdb_ins_code': '?', '_atom_site.cartn_x': '{:.3f}'.format(-12.5 + 1.25 * n),
+                '_atom_site.cartn_y': '{:.3f}'.format(3.75 - 0.5 * n), '_atom_site.cartn_z': '{:.3f}'.format(0.125 * n),
+                '_atom_site.occupancy': '1.00', '_atom_site.b_iso_or_equiv': '{:.2f}'.format(60 + 2.5 * n),
+                '_atom_site.pdbx_formal_charge': '?', '_atom_site.auth_seq_id': str(resNum),
+                '_atom_site.auth_comp_id': resName, '_atom_site.auth_asym_id': 'A', '_atom_site.auth_atom_id': atom,
+                '_atom_site.pdbx_pdb_model_num': '1', '_atom_site.pdbx_sifts_xref_db_acc': 'P12345',
+                '_atom_site.pdbx_sifts_xref_db_name': 'UNP',
+                '_atom_site.pdbx_sifts_xref_db_num': str(resNum + XREF_DB_NUM_OFFSET - 1),
+                '_atom_site.pdbx_sifts_xref_db_res': 'A'})
+    items = list(augment.ATOM_SITE_COLUMNS)
+    return augment.atomSiteBlock(name=AF_ENTRY_NAME.lower(), header={}, items=items,
+                                 columns=[[row[item] for row in rows] for item in items])
+
+
+def protonated_atoms():
+    """
+    Rows of Q_select_pdbAtoms: every heavy atom of a residue followed by the hydrogens REDUCE added
+    """
+    atoms = []
+    for resNum, (resName, heavyAtoms, hydrogens) in enumerate(RESIDUES, start=1):
+        for atom in heavyAtoms + hydrogens:
+            n = len(atoms) + 1
+            atoms.append({'atom_number': n, 'protein_atom': atom, 'residue_type': resName, 'chain': 'A',
+                          'residue_sequence': resNum, 'x_coord': 1.5 * n - 20, 'y_coord': 7.25 - 0.5 * n,
+                          'z_coord': 0.5 * n, 'element': atom[0]})
+    return atoms
+
+
+def shift_rows():
+    """
+    Rows of Q_compareCSP for the predictors with predictions, ordered by res_sequence. The first row of
+    predictor 1 is the first atom of residue 1 (row index 0) and predictor 2 predicts a shift of 0.0
+    """
+    shifts = {
+        1: [(1, 'N', 118.2), (1, 'CA', 45.1), (1, 'H', 8.31), (2, 'CA', 52.4), (2, 'HB1', 1.39), (3, 'OG', 0.5),
+            (3, 'HG', 5.12)],
+        2: [(1, 'CA', 44.9), (2, 'N', 0.0), (2, 'CB', 19.0), (2, 'HA', 4.3), (3, 'N', 116.7), (3, 'CA', 58.3)],
+        8: [(1, 'N', 109.8), (1, 'HA2', 3.95), (1, 'HA3', 3.88), (3, 'CB', 63.8), (3, 'CB', 63.9)],
+    }
+    return {cspID: [{'res_sequence': resNum, 'atom': atom, 'chemical_shift': value}
+                    for resNum, atom, value in rows] for cspID, rows in shifts.items()}
+
+
+def golden_shift_rows():
+    """
+    shift_rows() with each predictor's rows led by an N-terminal hydrogen the model names H, so no atom of the
+    model is the first row of a predictor, and without the predicted shift of 0.0. The writer before the
+    chemical shift lookup tested for None dropped both, these rows are written the same by either writer
+    """
+    golden = dict()
+    for cspID, rows in shift_rows().items():
+        golden[cspID] = [{'res_sequence': 1, 'atom': 'H1', 'chemical_shift': 8.05}] + \
+            [row for row in rows if row['chemical_shift'] != 0.0]
+    return golden
+
+
+def write_document(path, shifts):
+    csDict = augment.chemicalShiftIndex()
+    for cspID, rows in shifts.items():
+        csDict.add(cspID=cspID, rows=rows)
+    doc = augment.augmentedDocument()
+    augment.print_aug_atom_site(csDict=csDict, doc=doc, af_id=1, af_entry_name=AF_ENTRY_NAME, af_file=None,
+                                cifDict=model_block(), afH_atoms=protonated_atoms(), number_residues=len(RESIDUES))
+    doc.save(str(path))
+
+
+@pytest.fixture(autouse=True)
+def csp_ids(monkeypatch):
+    monkeypatch.setattr(augment, 'cspID_list', CSP_IDS, raising=False)
+
+
+def test_document_writer_matches_baseline_writer(tmp_path):
+    write_document(tmp_path / 'document.cif', golden_shift_rows())
+
+    golden = GOLDEN_FILE.read_bytes()
+    assert (tmp_path / 'document.cif').read_bytes() == golden
+    # one row per protonated atom after the loop header
+    assert golden.count(b'\nATOM ') == len(protonated_atoms())
+
+
+def test_shift_in_first_row_is_written(tmp_path):
+    write_document(tmp_path / 'document.cif', shift_rows())
+
+    rows = [line for line in (tmp_path / 'document.cif').read_text().splitlines() if line.startswith('ATOM ')]
+    # residue 1 N is row 0 of predictor 1, predictors 3 to 6 have no predictions
+    assert rows[0].startswith('ATOM 1  N N   . GLY ')
+    assert ' 118.200 .       .       .       .       .       109.800 ' in rows[0]
+    # a predicted shift of 0.0 is written, not dropped
+    ala_n = next(row for row in rows if row.startswith('ATOM 5  N N   . ALA '))
+    assert ' .       0.000   .       ' in ala_n